@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+from torch.func import jacrev, vmap
+
+# Rough peak memory per Jacobian entry of a sample, relative to the entry itself (jacobian + vmapped backward intermediates).
+# Used to size chunks so that one chunk stays within max_memory_bytes.
+JACOBIAN_MEMORY_FACTOR = 8
+INTEGRATED_GRADIENTS_STEPS = 16
+
+
+def get_sample_jacobians(model, data):
+    """Per-sample Jacobian of every model output w.r.t. every input column, shape (B, outputs, input_size)."""
+    def single_output(sample):
+        output, _ = model(sample.unsqueeze(0))
+        return output.squeeze(0)
+
+    return vmap(jacrev(single_output))(data)
+
+
+def get_sample_integrated_gradients(model, data, baseline, steps=INTEGRATED_GRADIENTS_STEPS):
+    """
+    Integrated gradients (midpoint Riemann sum over `steps` points) of every output, shape (B, outputs, input_size).
+    The currency column is an embedding index, so it is taken from the data rather than interpolated.
+    Note that interior points of the path don't hit the -0.01 / 0 sentinels, so the masks are only active at the endpoints.
+    """
+    baseline = baseline.expand_as(data).clone()
+    baseline[:, -1] = data[:, -1]
+    delta = data - baseline
+    total = 0
+    for step in range(steps):
+        alpha = (step + 0.5) / steps
+        total = total + get_sample_jacobians(model, baseline + alpha * delta)
+    return total / steps * delta.unsqueeze(1)
+
+
+def _get_inputs(dataset, indices):
+    if hasattr(dataset, 'tensors'):
+        return dataset.tensors[0][indices]
+    return torch.stack([dataset[int(i)][0] for i in indices])
+
+
+def get_attributions(model, val_loader, device, input_fields:list, output_fields:list, method='jacobian', max_samples=None,
+                     max_memory_bytes=2**30, baseline=None, steps=INTEGRATED_GRADIENTS_STEPS, per_sample_path=None, output_path=None, seed=42):
+    """
+    Input-to-output attributions for all output fields in one pass over (a random subset of) the validation set.
+
+    Args:
+        method: 'jacobian' (plain per-sample gradients) or 'integrated_gradients'
+        max_samples: if set, attribute a random subset of that many samples
+        max_memory_bytes: bound on the working memory of one chunk of samples
+        baseline: integrated gradients baseline, defaults to all zeros
+        per_sample_path: if set, per-sample attributions are streamed into a (samples, outputs, fields, years) .npy memmap
+        output_path: if set, the aggregated attributions are saved there with torch.save
+
+    Returns:
+        dict: 'sum' and 'abs_mean', both (outputs, fields, years) tensors, with years ordered n-3, n-2, n-1, plus 'indices' of the attributed samples
+    """
+    if method not in ('jacobian', 'integrated_gradients'):
+        raise ValueError(f'Unknown attribution method: {method}')
+    model.eval()
+    dataset = val_loader.dataset
+    num_fields = len(input_fields)
+    num_outputs = len(output_fields)
+    input_size = _get_inputs(dataset, [0]).shape[-1]
+    num_years = input_size // num_fields
+
+    indices = torch.arange(len(dataset))
+    if max_samples is not None and max_samples < len(dataset):
+        generator = torch.Generator().manual_seed(seed)
+        indices = torch.randperm(len(dataset), generator=generator)[:max_samples].sort().values
+
+    bytes_per_sample = num_outputs * input_size * 4 * JACOBIAN_MEMORY_FACTOR
+    if method == 'integrated_gradients':
+        bytes_per_sample *= 2
+    chunk_size = max(1, max_memory_bytes // bytes_per_sample)
+
+    per_sample = None
+    if per_sample_path is not None:
+        per_sample = np.lib.format.open_memmap(per_sample_path, mode='w+', dtype=np.float32, shape=(len(indices), num_outputs, num_fields, num_years))
+
+    attribution_sum = torch.zeros(num_outputs, num_fields, num_years, device=device)
+    attribution_abs_sum = torch.zeros(num_outputs, num_fields, num_years, device=device)
+    if baseline is None:
+        baseline = torch.zeros(input_size)
+    baseline = baseline.to(device)
+
+    for start in range(0, len(indices), chunk_size):
+        data = _get_inputs(dataset, indices[start:start + chunk_size]).to(device)
+        if method == 'jacobian':
+            attributions = get_sample_jacobians(model, data)
+        else:
+            attributions = get_sample_integrated_gradients(model, data, baseline, steps=steps)
+
+        # Flattened window is year-major: column = year * num_fields + field
+        attributions = attributions.detach().view(-1, num_outputs, num_years, num_fields).transpose(2, 3)
+        attribution_sum += attributions.sum(dim=0)
+        attribution_abs_sum += attributions.abs().sum(dim=0)
+        if per_sample is not None:
+            per_sample[start:start + data.shape[0]] = attributions.cpu().numpy()
+
+    if per_sample is not None:
+        per_sample.flush()
+
+    result = {
+        'sum': attribution_sum.cpu(),
+        'abs_mean': (attribution_abs_sum / max(len(indices), 1)).cpu(),
+        'indices': indices,
+        'input_fields': list(input_fields),
+        'output_fields': list(output_fields),
+    }
+    if output_path is not None:
+        torch.save(result, output_path)
+    return result
@@ -0,0 +1,127 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import torch.optim as optim
+
+from evaluation import evaluate
+from train import BATCH_SIZE, INPUT_FIELDS, LEARNING_RATE, OUTPUT_VECTOR_FIELDS, WEIGHT_DECAY, MaskedNet, train_epoch
+
+BACKTEST_DATA_PATH = 'backtest_data.pt'
+BACKTEST_RESULTS_PATH = 'backtest_results.json'
+BACKTEST_EPOCHS = 10
+WINDOW_YEARS = 3
+MIN_TRAIN_WINDOWS = 1000
+
+
+def prepare_backtest_data(full_dataset, mean, std, path=BACKTEST_DATA_PATH):
+    """
+    Stores the preprocessed dataset as one contiguous (rows, fields) tensor with per-company row offsets and the raw calendar
+    year of every row, so that fold workers can memory-map a single shared copy.
+    """
+    year_index = INPUT_FIELDS.index('calendarYear')
+    statements = torch.cat(list(full_dataset)).contiguous()
+    lengths = torch.tensor([company_statements.shape[0] for company_statements in full_dataset])
+    offsets = torch.cat((torch.zeros(1, dtype=torch.long), lengths.cumsum(0)))
+    years = torch.round(statements[:, year_index] * std[year_index] + mean[year_index]).to(torch.int16)
+    torch.save({'statements': statements, 'offsets': offsets, 'years': years}, path)
+    return path
+
+
+def get_fold_rows(offsets, years, train_until, window_years=WINDOW_YEARS):
+    """
+    Target rows of the walk-forward fold trained on years <= train_until and tested on train_until + 1.
+    Each row r stands for the window statements[r - window_years:r] -> statements[r], nothing is copied.
+    """
+    lengths = offsets[1:] - offsets[:-1]
+    company_of_row = torch.repeat_interleave(torch.arange(len(lengths)), lengths)
+    # A row can be a target when the company has window_years statements before it
+    has_window = torch.arange(len(years)) - offsets[company_of_row] >= window_years
+    train_rows = torch.nonzero(has_window & (years <= train_until)).squeeze(1)
+    test_rows = torch.nonzero(has_window & (years == train_until + 1)).squeeze(1)
+    return train_rows, test_rows
+
+
+class WindowIndexLoader:
+    """Batches (window, target) pairs gathered from the shared statements tensor by target row, like the DataLoaders of train.py."""
+    def __init__(self, statements, rows, output_field_indices, batch_size=BATCH_SIZE, shuffle=False, window_years=WINDOW_YEARS):
+        self.statements = statements
+        self.rows = rows
+        self.output_field_indices = output_field_indices
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.window_offsets = torch.arange(-window_years, 0)
+
+    def __len__(self):
+        return (len(self.rows) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        rows = self.rows[torch.randperm(len(self.rows))] if self.shuffle else self.rows
+        for start in range(0, len(rows), self.batch_size):
+            batch_rows = rows[start:start + self.batch_size]
+            data = self.statements[batch_rows.unsqueeze(1) + self.window_offsets].flatten(1)
+            targets = self.statements[batch_rows][:, self.output_field_indices]
+            yield data, targets
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def run_fold(train_until, data_path=BACKTEST_DATA_PATH, epochs=BACKTEST_EPOCHS, seed=42):
+    """Trains a fresh MaskedNet on the windows up to train_until and returns its per-field errors on train_until + 1."""
+    torch.manual_seed(seed)
+    data = torch.load(data_path, mmap=True)
+    output_field_indices = torch.tensor([INPUT_FIELDS.index(field) for field in OUTPUT_VECTOR_FIELDS])
+    train_rows, test_rows = get_fold_rows(data['offsets'], data['years'], train_until)
+    if len(train_rows) < MIN_TRAIN_WINDOWS or len(test_rows) == 0:
+        return {'train_until': train_until, 'train_windows': len(train_rows), 'test_windows': len(test_rows), 'skipped': True}
+
+    train_loader = WindowIndexLoader(data['statements'], train_rows, output_field_indices, shuffle=True)
+    test_loader = WindowIndexLoader(data['statements'], test_rows, output_field_indices)
+    device = torch.device('cpu')
+    model = MaskedNet(
+        input_size=3*len(INPUT_FIELDS),
+        output_size=len(OUTPUT_VECTOR_FIELDS),
+        number_of_currencies=47,
+    )
+    optimizer = optim.AdamW(model.parameters(), lr=LEARNING_RATE, weight_decay=WEIGHT_DECAY)
+    for _ in range(epochs):
+        train_loss = train_epoch(model, train_loader, optimizer, device)
+
+    metrics = evaluate(model, test_loader, device, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=INPUT_FIELDS)
+    return {'train_until': train_until, 'train_windows': len(train_rows), 'test_windows': len(test_rows), 'train_loss': train_loss, **metrics}
+
+
+def backtest(train_until_years, data_path=BACKTEST_DATA_PATH, epochs=BACKTEST_EPOCHS, workers=None, results_path=BACKTEST_RESULTS_PATH):
+    """
+    Runs the walk-forward folds concurrently in a process pool over the shared memory-mapped dataset, and aggregates the
+    per-fold, per-field test errors.
+    """
+    workers = workers or min(len(train_until_years), os.cpu_count() or 1)
+    # Folds train on CPU, split the cores between them rather than letting every worker use all of them
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads,)) as executor:
+        folds = list(executor.map(run_fold, train_until_years, [data_path] * len(train_until_years), [epochs] * len(train_until_years)))
+
+    folds = [fold for fold in folds if not fold.get('skipped')]
+    table = [
+        {'train_until': fold['train_until'], 'field': field, **values}
+        for fold in folds for field, values in fold['fields'].items()
+    ]
+    summary = {
+        field: {metric: sum(row[metric] for row in table if row['field'] == field) / len(folds) for metric in ('loss', 'target_loss', 'composite_loss')}
+        for field in OUTPUT_VECTOR_FIELDS
+    } if folds else {}
+    with open(results_path, 'w') as file:
+        json.dump({'folds': folds, 'table': table, 'summary': summary}, file, indent=2)
+
+    for fold in folds:
+        print(f'Train <= {fold["train_until"]}, test {fold["train_until"] + 1}: {fold["test_windows"]} windows, Val Loss: {fold["loss"]:.4f}, Target: {fold["target_loss"]:.4f}')
+    return table, summary
+
+
+if __name__ == '__main__':
+    if not os.path.exists(BACKTEST_DATA_PATH):
+        prepare_backtest_data(torch.load('full_data.pt'), torch.load('mean.pt'), torch.load('std.pt'))
+    backtest(list(range(2008, 2023)))
@@ -0,0 +1,151 @@
+import argparse
+import copy
+import json
+import platform
+import random
+import statistics
+import time
+import torch
+import torch.optim as optim
+
+from evaluation import evaluate
+from helpers.niceify_data import FIELDS_AND_LIMITS, niceify_data
+from train import INPUT_FIELDS, OUTPUT_VECTOR_FIELDS, MaskedLayer, MaskedNet, get_train_dataloader, get_val_dataloader, train_epoch
+
+BENCHMARK_COMPANIES = 500
+BENCHMARK_YEARS = 12
+BENCHMARK_REPEATS = 3
+INFERENCE_BATCH_SIZES = [1, 64, 512, 4096]
+REGRESSION_THRESHOLD = 0.2  # flag stages more than 20% slower than the baseline
+RESULTS_PATH = 'benchmark_results.json'
+BASELINE_PATH = 'benchmark_baseline.json'
+BENCHMARK_CURRENCIES = ["USD", "EUR", "CAD", "GBP", "JPY", "CNY"]
+
+
+def get_benchmark_statements(num_companies, num_years, seed=0):
+    """Fixed synthetic raw statements in the merged FMP layout (newest year first), uniformly drawn within FIELDS_AND_LIMITS."""
+    rng = random.Random(seed)
+    financial_statements = {}
+    for company in range(num_companies):
+        currency = rng.choice(BENCHMARK_CURRENCIES)
+        statements = []
+        for year in range(2023, 2023 - num_years, -1):
+            statement = {}
+            for field, limit in FIELDS_AND_LIMITS.items():
+                if limit is None:
+                    continue
+                # A share of exact zeros and missing values, so that both sentinels show up in the preprocessed data
+                draw = rng.random()
+                statement[field] = 0 if draw < 0.1 else None if draw < 0.15 else rng.uniform(*limit)
+            statement['calendarYear'] = str(year)
+            statement['reportedCurrency'] = currency
+            statements.append(statement)
+        financial_statements[f'SYN{company}'] = statements
+    return financial_statements
+
+
+def time_stage(function, repeats, setup=None):
+    timings = []
+    for _ in range(repeats):
+        arguments = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        timings.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(timings), 'min_s': min(timings), 'repeats': repeats}
+
+
+def run_benchmarks(num_companies=BENCHMARK_COMPANIES, num_years=BENCHMARK_YEARS, repeats=BENCHMARK_REPEATS, batch_size=512, device=torch.device('cpu')):
+    torch.manual_seed(0)
+    results = {}
+    raw_statements = get_benchmark_statements(num_companies, num_years)
+    # niceify_data rewrites the statements in place, so every repeat gets a fresh copy
+    results['niceify_data'] = time_stage(lambda statements: niceify_data(statements, save=False), repeats, setup=lambda: copy.deepcopy(raw_statements))
+    full_dataset = niceify_data(copy.deepcopy(raw_statements), save=False)
+
+    output_field_indices = torch.tensor([INPUT_FIELDS.index(field) for field in OUTPUT_VECTOR_FIELDS])
+    results['get_train_dataloader'] = time_stage(lambda: get_train_dataloader(full_dataset, output_field_indices, batch_size), repeats)
+    results['get_val_dataloader'] = time_stage(lambda: get_val_dataloader(full_dataset, output_field_indices, batch_size), repeats)
+    train_loader = get_train_dataloader(full_dataset, output_field_indices, batch_size)
+    val_loader = get_val_dataloader(full_dataset, output_field_indices, batch_size)
+
+    model = MaskedNet(input_size=3*len(INPUT_FIELDS), output_size=len(OUTPUT_VECTOR_FIELDS), number_of_currencies=47).to(device)
+    optimizer = optim.AdamW(model.parameters())
+    results['train_epoch'] = time_stage(lambda: train_epoch(model, train_loader, optimizer, device), repeats)
+    results['train_epoch']['samples'] = len(train_loader.dataset)
+    # The validation pass train() runs every epoch
+    results['evaluate'] = time_stage(lambda: evaluate(model, val_loader, device, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=INPUT_FIELDS, quantiles=None), repeats)
+    results['evaluate']['samples'] = len(val_loader.dataset)
+
+    model.eval()
+    layer = next(module for module in model.modules() if isinstance(module, MaskedLayer))
+    layer_input = torch.randn(batch_size, layer.main_proj.in_features, device=device)
+    with torch.no_grad():
+        results['masked_layer_forward'] = time_stage(lambda: layer(layer_input, layer_input, layer_input), repeats)
+
+        inputs = val_loader.dataset.tensors[0]
+        for inference_batch_size in INFERENCE_BATCH_SIZES:
+            batch = inputs[torch.arange(inference_batch_size) % inputs.shape[0]].to(device)
+            results[f'inference_batch_{inference_batch_size}'] = time_stage(lambda: model(batch), repeats)
+            results[f'inference_batch_{inference_batch_size}']['samples'] = inference_batch_size
+
+    for stage in results.values():
+        if 'samples' in stage:
+            stage['samples_per_sec'] = stage['samples'] / stage['median_s']
+
+    return {
+        'config': {'companies': num_companies, 'years': num_years, 'repeats': repeats, 'batch_size': batch_size, 'device': str(device)},
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'machine': platform.machine(), 'threads': torch.get_num_threads()},
+        'stages': results,
+    }
+
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Returns the names of the stages whose median time is more than `threshold` above the baseline's, and prints the comparison."""
+    if baseline['config'] != results['config']:
+        print(f"Warning: baseline config {baseline['config']} differs from current config {results['config']}")
+    regressions = []
+    print(f'{"Stage":<28}{"Baseline (s)":>14}{"Current (s)":>14}{"Ratio":>8}')
+    for stage, timings in results['stages'].items():
+        if stage not in baseline['stages']:
+            print(f'{stage:<28}{"-":>14}{timings["median_s"]:>14.4f}{"-":>8}')
+            continue
+        baseline_time = baseline['stages'][stage]['median_s']
+        ratio = timings['median_s'] / baseline_time
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(stage)
+            flag = '  REGRESSION'
+        print(f'{stage:<28}{baseline_time:>14.4f}{timings["median_s"]:>14.4f}{ratio:>8.2f}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times preprocessing, dataset building, training and inference on a fixed synthetic dataset.')
+    parser.add_argument('--companies', type=int, default=BENCHMARK_COMPANIES)
+    parser.add_argument('--years', type=int, default=BENCHMARK_YEARS)
+    parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS)
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the new baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.companies, args.years, args.repeats)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Baseline written to {args.baseline}')
+    else:
+        try:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            print(f'No baseline at {args.baseline}, run with --update-baseline to create one')
+            raise SystemExit(0)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f'Regressions above {args.threshold:.0%}: {", ".join(regressions)}')
+            raise SystemExit(1)
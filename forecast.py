@@ -0,0 +1,111 @@
+import torch
+
+from helpers.niceify_data import RATIO_FIELDS
+from train import DEVICE, INPUT_FIELDS, OUTPUT_VECTOR_FIELDS, MaskedNet, load_checkpoint
+
+WINDOW_YEARS = 3
+FORECAST_HORIZON = 5
+DEFAULT_GROWTH_RATE = 0.03
+# Fields the growth policy carries over as they are: no basis for compounding margins or share counts
+UNSCALED_FIELDS = ('calendarYear', 'reportedCurrency', *RATIO_FIELDS, 'weightedAverageShsOut', 'weightedAverageShsOutDil')
+
+
+def get_last_windows(full_dataset, window_years=WINDOW_YEARS):
+    """
+    Stacks the last window_years statements of every company with enough history into a (companies, window_years, fields) tensor.
+
+    Returns:
+        tuple: (windows, indices of the companies in full_dataset)
+    """
+    company_indices = [index for index, company_statements in enumerate(full_dataset) if company_statements.shape[0] >= window_years]
+    windows = torch.stack([full_dataset[index][-window_years:] for index in company_indices])
+    return windows, torch.tensor(company_indices)
+
+
+def carry_over_policy(windows, mean, std):
+    return windows[:, -1].clone()
+
+
+def make_growth_policy(growth_rate=DEFAULT_GROWTH_RATE, unscaled_fields=UNSCALED_FIELDS):
+    """
+    Fills the next year by growing last year's raw (denormalized) values by growth_rate, except unscaled_fields which
+    are carried over. Zero and invalid values (the 0 and -0.01 sentinels) stay as they are.
+    """
+    unscaled_indices = [INPUT_FIELDS.index(field) for field in unscaled_fields]
+
+    def growth_policy(windows, mean, std):
+        last = windows[:, -1]
+        raw = last * std + mean
+        grown = (raw * (1 + growth_rate) - mean) / std
+        grown[:, unscaled_indices] = last[:, unscaled_indices]
+        return torch.where((last == 0) | (last == -.01), last, grown)
+
+    return growth_policy
+
+
+FILL_POLICIES = {
+    'carry_over': carry_over_policy,
+    'growth': make_growth_policy(),
+}
+
+
+def forecast(model, windows, mean, std, input_fields:list[str]=INPUT_FIELDS, output_fields:list[str]=OUTPUT_VECTOR_FIELDS,
+             horizon=FORECAST_HORIZON, fill_policy='carry_over', device=DEVICE):
+    """
+    Autoregressive rollout: each horizon year is one batched forward over all companies, whose predictions are written
+    into the next statement, the fields the model doesn't predict being filled by fill_policy, before sliding the window.
+
+    Args:
+        windows: (companies, years, fields) normalized statements, oldest first, e.g. from get_last_windows
+        fill_policy: name in FILL_POLICIES or callable (windows, mean, std) -> (companies, fields) next statement
+
+    Returns:
+        tensor: (companies, horizon, len(output_fields)) normalized predictions
+    """
+    model.eval()
+    fill_policy = FILL_POLICIES[fill_policy] if isinstance(fill_policy, str) else fill_policy
+    output_indices = torch.tensor([input_fields.index(field) for field in output_fields], device=device)
+    year_index = input_fields.index('calendarYear')
+    windows = windows.to(device)
+    mean, std = mean.to(device), std.to(device)
+
+    predictions = []
+    with torch.no_grad():
+        for _ in range(horizon):
+            output, _ = model(windows.flatten(1))
+            predictions.append(output)
+
+            next_statement = fill_policy(windows, mean, std)
+            next_statement[:, output_indices] = output
+            # calendarYear is z-scored too, one year later is 1/std further
+            next_statement[:, year_index] = windows[:, -1, year_index] + 1 / std[year_index]
+            windows = torch.cat((windows[:, 1:], next_statement.unsqueeze(1)), dim=1)
+
+    return torch.stack(predictions, dim=1)
+
+
+def denormalize(predictions, mean, std, input_fields:list[str]=INPUT_FIELDS, output_fields:list[str]=OUTPUT_VECTOR_FIELDS):
+    """Normalized predictions (..., len(output_fields)) back to USD values."""
+    indices = torch.tensor([input_fields.index(field) for field in output_fields])
+    return predictions * std[indices].to(predictions.device) + mean[indices].to(predictions.device)
+
+
+def forecast_universe(model_path='test_model.pt', horizon=FORECAST_HORIZON, fill_policy='carry_over'):
+    full_dataset = torch.load('full_data.pt')
+    mean, std = torch.load('mean.pt'), torch.load('std.pt')
+    windows, company_indices = get_last_windows(full_dataset)
+
+    model = MaskedNet(
+        input_size=3*len(INPUT_FIELDS),
+        output_size=len(OUTPUT_VECTOR_FIELDS),
+        number_of_currencies=47,
+    ).to(DEVICE)
+    model.load_state_dict(load_checkpoint(model_path, map_location=DEVICE))
+
+    predictions = forecast(model, windows, mean, std, horizon=horizon, fill_policy=fill_policy)
+    return company_indices, denormalize(predictions.cpu(), mean, std)
+
+
+if __name__ == '__main__':
+    company_indices, predictions = forecast_universe()
+    print(f'Forecast {predictions.shape[1]} years of {", ".join(OUTPUT_VECTOR_FIELDS)} for {predictions.shape[0]} companies')
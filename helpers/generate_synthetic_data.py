@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+from multiprocessing import Pool
+import numpy as np
+import torch
+
+from helpers.niceify_data import CURRENCY_EXCHANGE_RATES, CURRENCY_INDICES, FIELDS_AND_LIMITS, RATIO_FIELDS, get_statement_vectors, normalize_reports, save_shard
+
+COMPANIES_PER_SHARD = 1000  # same number of tickers per file as merge_financial_statements.py
+LAST_YEAR = 2023
+MAX_YEARS = 25
+USD_SHARE = 0.6  # the rest of the companies report in a uniformly drawn currency from CURRENCY_INDICES
+MISSING_RATE = 0.02
+OUTLIER_RATE = 0.002
+NUMERIC_FIELDS = [field for field, limit in FIELDS_AND_LIMITS.items() if limit is not None]
+# Reported as is rather than in the local currency
+NOT_IN_LOCAL_CURRENCY = set(RATIO_FIELDS + ['weightedAverageShsOut', 'weightedAverageShsOutDil'])
+
+
+def _generate_years(rng, num_companies, num_years):
+    """
+    USD values of every numeric field for num_companies companies over num_years years (oldest first), as a list of
+    {field: (num_companies,) array} dicts. Subtotals, ratios, per-share values, the balance sheet identity and the
+    cash flow bridge between consecutive balance sheets hold exactly before missing values and outliers are injected.
+    """
+    n = num_companies
+
+    def share(low, high):
+        return rng.uniform(low, high, n)
+
+    def jitter(values, scale=0.05):
+        return values * (1 + rng.normal(0, scale, n))
+
+    # Company-level structure, drifting a little from year to year through jitter()
+    revenue = np.exp(rng.normal(np.log(3e8), 1.5, n)).clip(1e5, 5e10)
+    growth = rng.normal(0.05, 0.05, n)
+    cost_of_revenue_share = share(0.3, 0.9)
+    rd_share = share(0, 0.15) * (rng.random(n) < 0.5)
+    ga_share = share(0.02, 0.1)
+    sm_share = share(0, 0.1) * (rng.random(n) < 0.7)
+    da_share = share(0.01, 0.08)
+    tax_rate = share(0.15, 0.3)
+    assets_to_revenue = share(0.5, 3)
+    liabilities_share = share(0.3, 0.85)
+    cash_share = share(0.02, 0.2)
+    payout_share = share(0, 0.5) * (rng.random(n) < 0.5)
+    buyback_share = share(0, 0.3) * (rng.random(n) < 0.3)
+    shares_outstanding = revenue / share(5, 200)
+    dilution = share(1, 1.03)
+    minority_share = share(0, 0.05) * (rng.random(n) < 0.3)
+
+    years = []
+    previous = None
+    for year in range(num_years):
+        if year > 0:
+            revenue = (revenue * np.exp(rng.normal(growth, 0.15))).clip(1e5, 9e10)
+            shares_outstanding = shares_outstanding * (1 + rng.normal(0.01, 0.02, n)).clip(0.9, 1.2)
+        f = {'revenue': revenue}
+
+        # Income statement
+        f['costOfRevenue'] = revenue * jitter(cost_of_revenue_share).clip(0, 0.99)
+        f['grossProfit'] = revenue - f['costOfRevenue']
+        f['researchAndDevelopmentExpenses'] = revenue * jitter(rd_share)
+        f['generalAndAdministrativeExpenses'] = revenue * jitter(ga_share)
+        f['sellingAndMarketingExpenses'] = revenue * jitter(sm_share)
+        f['sellingGeneralAndAdministrativeExpenses'] = f['generalAndAdministrativeExpenses'] + f['sellingAndMarketingExpenses']
+        f['otherExpenses'] = revenue * rng.normal(0, 0.005, n)
+        f['operatingExpenses'] = f['researchAndDevelopmentExpenses'] + f['sellingGeneralAndAdministrativeExpenses'] + f['otherExpenses']
+        f['costAndExpenses'] = f['costOfRevenue'] + f['operatingExpenses']
+        f['operatingIncome'] = revenue - f['costAndExpenses']
+        f['depreciationAndAmortization'] = revenue * jitter(da_share)
+        f['ebitda'] = f['operatingIncome'] + f['depreciationAndAmortization']
+
+        # Balance sheet, assets
+        total_assets = revenue * jitter(assets_to_revenue)
+        f['cashAndCashEquivalents'] = total_assets * jitter(cash_share)
+        f['shortTermInvestments'] = total_assets * share(0, 0.05)
+        f['cashAndShortTermInvestments'] = f['cashAndCashEquivalents'] + f['shortTermInvestments']
+        f['netReceivables'] = revenue * share(0.05, 0.2)
+        f['inventory'] = f['costOfRevenue'] * share(0, 0.2)
+        f['otherCurrentAssets'] = total_assets * share(0, 0.03)
+        f['totalCurrentAssets'] = f['cashAndShortTermInvestments'] + f['netReceivables'] + f['inventory'] + f['otherCurrentAssets']
+        f['totalNonCurrentAssets'] = np.maximum(total_assets - f['totalCurrentAssets'], total_assets * 0.1)
+        non_current = f['totalNonCurrentAssets']
+        f['goodwill'] = non_current * share(0, 0.25)
+        f['intangibleAssets'] = non_current * share(0, 0.1)
+        f['goodwillAndIntangibleAssets'] = f['goodwill'] + f['intangibleAssets']
+        f['longTermInvestments'] = non_current * share(0, 0.1)
+        f['taxAssets'] = non_current * share(0, 0.03)
+        f['otherNonCurrentAssets'] = non_current * share(0, 0.05)
+        f['propertyPlantEquipmentNet'] = non_current - f['goodwillAndIntangibleAssets'] - f['longTermInvestments'] - f['taxAssets'] - f['otherNonCurrentAssets']
+        f['otherAssets'] = np.zeros(n)
+        f['totalAssets'] = f['totalCurrentAssets'] + f['totalNonCurrentAssets']
+
+        # Balance sheet, liabilities and equity
+        total_liabilities = f['totalAssets'] * jitter(liabilities_share)
+        f['accountPayables'] = f['costOfRevenue'] * share(0.05, 0.2)
+        f['shortTermDebt'] = total_liabilities * share(0, 0.1)
+        f['deferredRevenue'] = revenue * share(0, 0.05)
+        f['otherCurrentLiabilities'] = total_liabilities * share(0, 0.05)
+        f['longTermDebt'] = total_liabilities * share(0.1, 0.4)
+        f['deferredRevenueNonCurrent'] = f['deferredRevenue'] * share(0, 0.3)
+        f['deferredTaxLiabilitiesNonCurrent'] = total_liabilities * share(0, 0.03)
+        f['capitalLeaseObligations'] = total_liabilities * share(0, 0.05)
+        f['otherLiabilities'] = np.zeros(n)
+        f['totalDebt'] = f['shortTermDebt'] + f['longTermDebt']
+
+        # Income statement below operating income, which needs cash and debt
+        f['interestIncome'] = f['cashAndShortTermInvestments'] * share(0.005, 0.03)
+        f['interestExpense'] = f['totalDebt'] * share(0.02, 0.07)
+        f['totalOtherIncomeExpensesNet'] = f['interestIncome'] - f['interestExpense'] + revenue * rng.normal(0, 0.005, n)
+        f['incomeBeforeTax'] = f['operatingIncome'] + f['totalOtherIncomeExpensesNet']
+        f['incomeTaxExpense'] = np.maximum(f['incomeBeforeTax'], 0) * tax_rate
+        f['netIncome'] = f['incomeBeforeTax'] - f['incomeTaxExpense']
+        f['grossProfitRatio'] = f['grossProfit'] / revenue
+        f['ebitdaratio'] = f['ebitda'] / revenue
+        f['operatingIncomeRatio'] = f['operatingIncome'] / revenue
+        f['incomeBeforeTaxRatio'] = f['incomeBeforeTax'] / revenue
+        f['netIncomeRatio'] = f['netIncome'] / revenue
+        f['weightedAverageShsOut'] = shares_outstanding
+        f['weightedAverageShsOutDil'] = shares_outstanding * dilution
+        f['eps'] = f['netIncome'] / f['weightedAverageShsOut']
+        f['epsdiluted'] = f['netIncome'] / f['weightedAverageShsOutDil']
+
+        f['taxPayables'] = f['incomeTaxExpense'] * share(0, 0.5)
+        f['totalCurrentLiabilities'] = f['accountPayables'] + f['shortTermDebt'] + f['taxPayables'] + f['deferredRevenue'] + f['otherCurrentLiabilities']
+        long_term = f['longTermDebt'] + f['deferredRevenueNonCurrent'] + f['deferredTaxLiabilitiesNonCurrent'] + f['capitalLeaseObligations']
+        f['otherNonCurrentLiabilities'] = np.maximum(total_liabilities - f['totalCurrentLiabilities'] - long_term, 0)
+        f['totalNonCurrentLiabilities'] = long_term + f['otherNonCurrentLiabilities']
+        f['totalLiabilities'] = f['totalCurrentLiabilities'] + f['totalNonCurrentLiabilities']
+        f['totalEquity'] = f['totalAssets'] - f['totalLiabilities']
+        f['minorityInterest'] = f['totalEquity'] * minority_share
+        f['totalStockholdersEquity'] = f['totalEquity'] - f['minorityInterest']
+        f['preferredStock'] = np.zeros(n)
+        f['commonStock'] = np.abs(f['totalStockholdersEquity']) * share(0, 0.1)
+        f['retainedEarnings'] = f['totalStockholdersEquity'] * share(0.2, 0.9)
+        f['accumulatedOtherComprehensiveIncomeLoss'] = f['totalStockholdersEquity'] * rng.normal(0, 0.02, n)
+        f['othertotalStockholdersEquity'] = f['totalStockholdersEquity'] - f['preferredStock'] - f['commonStock'] - f['retainedEarnings'] - f['accumulatedOtherComprehensiveIncomeLoss']
+        f['totalLiabilitiesAndStockholdersEquity'] = f['totalLiabilities'] + f['totalStockholdersEquity']
+        f['totalLiabilitiesAndTotalEquity'] = f['totalLiabilities'] + f['totalEquity']
+        f['totalInvestments'] = f['shortTermInvestments'] + f['longTermInvestments']
+        f['netDebt'] = f['totalDebt'] - f['cashAndCashEquivalents']
+
+        # Cash flow statement, bridging the previous balance sheet to this one
+        last = previous if previous is not None else f
+        f['deferredIncomeTax'] = f['incomeTaxExpense'] * rng.normal(0, 0.05, n)
+        f['stockBasedCompensation'] = revenue * share(0, 0.02)
+        f['accountsReceivables'] = -(f['netReceivables'] - last['netReceivables'])
+        f['accountsPayables'] = f['accountPayables'] - last['accountPayables']
+        f['otherWorkingCapital'] = -(f['inventory'] - last['inventory']) + revenue * rng.normal(0, 0.002, n)
+        f['changeInWorkingCapital'] = f['accountsReceivables'] + f['accountsPayables'] + f['otherWorkingCapital']
+        f['otherNonCashItems'] = revenue * rng.normal(0, 0.005, n)
+        f['netCashProvidedByOperatingActivities'] = f['netIncome'] + f['depreciationAndAmortization'] + f['deferredIncomeTax'] + f['stockBasedCompensation'] + f['changeInWorkingCapital'] + f['otherNonCashItems']
+        f['operatingCashFlow'] = f['netCashProvidedByOperatingActivities']
+        f['investmentsInPropertyPlantAndEquipment'] = -f['depreciationAndAmortization'] * share(0.8, 1.5)
+        f['capitalExpenditure'] = f['investmentsInPropertyPlantAndEquipment']
+        f['freeCashFlow'] = f['operatingCashFlow'] + f['capitalExpenditure']
+        f['acquisitionsNet'] = -revenue * share(0, 0.05) * (rng.random(n) < 0.2)
+        f['purchasesOfInvestments'] = -f['totalAssets'] * share(0, 0.03)
+        f['salesMaturitiesOfInvestments'] = f['totalAssets'] * share(0, 0.03)
+        f['otherInvestingActivites'] = revenue * rng.normal(0, 0.002, n)
+        f['netCashUsedForInvestingActivites'] = f['investmentsInPropertyPlantAndEquipment'] + f['acquisitionsNet'] + f['purchasesOfInvestments'] + f['salesMaturitiesOfInvestments'] + f['otherInvestingActivites']
+        f['debtRepayment'] = -last['totalDebt'] * share(0, 0.2)
+        f['commonStockIssued'] = revenue * share(0, 0.02)
+        f['commonStockRepurchased'] = -np.maximum(f['netIncome'], 0) * buyback_share
+        f['dividendsPaid'] = -np.maximum(f['netIncome'], 0) * payout_share
+        f['effectOfForexChangesOnCash'] = f['cashAndCashEquivalents'] * rng.normal(0, 0.005, n)
+        f['cashAtBeginningOfPeriod'] = last['cashAndCashEquivalents'] if previous is not None else f['cashAndCashEquivalents'] * jitter(np.ones(n), 0.1)
+        f['cashAtEndOfPeriod'] = f['cashAndCashEquivalents']
+        f['netChangeInCash'] = f['cashAtEndOfPeriod'] - f['cashAtBeginningOfPeriod']
+        # Other financing activities close the bridge between the cash flows and the change in cash
+        explained = f['netCashProvidedByOperatingActivities'] + f['netCashUsedForInvestingActivites'] + f['effectOfForexChangesOnCash'] + f['debtRepayment'] + f['commonStockIssued'] + f['commonStockRepurchased'] + f['dividendsPaid']
+        f['otherFinancingActivites'] = f['netChangeInCash'] - explained
+        f['netCashUsedProvidedByFinancingActivities'] = f['debtRepayment'] + f['commonStockIssued'] + f['commonStockRepurchased'] + f['dividendsPaid'] + f['otherFinancingActivites']
+
+        years.append(f)
+        previous = f
+    return years
+
+
+def generate_statements(rng, num_companies, max_years=MAX_YEARS, missing_rate=MISSING_RATE, outlier_rate=OUTLIER_RATE, ticker_prefix='SYN'):
+    """Raw merged statements {ticker: [statement, ...]} (newest first), as merge_financial_statements.py emits them."""
+    years = _generate_years(rng, num_companies, max_years)
+    # (years, companies, fields) in NUMERIC_FIELDS order
+    values = np.stack([np.stack([year[field] for field in NUMERIC_FIELDS], axis=-1) for year in years])
+
+    currency_names = list(CURRENCY_INDICES)
+    currencies = np.where(rng.random(num_companies) < USD_SHARE, 'USD', rng.choice(currency_names, num_companies))
+    rates = np.array([CURRENCY_EXCHANGE_RATES[currency] for currency in currencies])
+    scaled = np.array([field not in NOT_IN_LOCAL_CURRENCY for field in NUMERIC_FIELDS])
+    values = np.where(scaled, values * rates[None, :, None], values)
+
+    # Out-of-limit outliers (unit mistakes, bad parses) and missing values
+    outliers = rng.random(values.shape) < outlier_rate
+    values = np.where(outliers, values * 10 ** rng.uniform(2, 4, values.shape), values)
+    missing = rng.random(values.shape) < missing_rate
+
+    history_lengths = rng.integers(1, max_years + 1, num_companies)
+    last_years = LAST_YEAR - (rng.random(num_companies) < 0.1)
+    financial_statements = {}
+    for company in range(num_companies):
+        ticker = f'{ticker_prefix}{company:06d}'
+        statements = []
+        for year_index in range(max_years - 1, max_years - 1 - history_lengths[company], -1):
+            calendar_year = int(last_years[company] - (max_years - 1 - year_index))
+            statement = dict(zip(NUMERIC_FIELDS, values[year_index, company].tolist()))
+            for field_index in np.flatnonzero(missing[year_index, company]):
+                statement[NUMERIC_FIELDS[field_index]] = None
+            statement.update({
+                'date': f'{calendar_year}-12-31',
+                'symbol': ticker,
+                'reportedCurrency': str(currencies[company]),
+                'calendarYear': str(calendar_year),
+                'period': 'FY',
+            })
+            statements.append(statement)
+        financial_statements[ticker] = statements
+    return financial_statements
+
+
+def _generate_shard(task):
+    shard_index, num_companies, output_dir, output_format, seed, max_years, missing_rate, outlier_rate, mean, std = task
+    rng = np.random.default_rng([seed, shard_index])
+    financial_statements = generate_statements(rng, num_companies, max_years, missing_rate, outlier_rate, ticker_prefix=f'SYN{shard_index:05d}')
+    if output_format == 'raw':
+        path = os.path.join(output_dir, f'full_reports_{shard_index}.json')
+        with open(path, 'w+') as file:
+            json.dump(financial_statements, file)
+        return path
+
+    normalized_data = []
+    for company_statements in financial_statements.values():
+        vectors, _ = get_statement_vectors(company_statements)
+        if len(vectors) == 0:
+            continue
+        normalized_data.append(normalize_reports(torch.tensor(vectors), mean, std))
+    return save_shard(normalized_data, output_dir, shard_index)
+
+
+def generate(num_companies, output_dir='data', output_format='raw', companies_per_shard=COMPANIES_PER_SHARD, workers=None, seed=0,
+             max_years=MAX_YEARS, missing_rate=MISSING_RATE, outlier_rate=OUTLIER_RATE, mean_path='mean.pt', std_path='std.pt'):
+    """
+    Generates num_companies synthetic companies shard by shard in a process pool, each worker holding a single shard in memory.
+    output_format 'raw' writes full_reports_{i}.json files like merge_financial_statements.py, 'preprocessed' writes
+    shards of normalized tensors (see save_shard) using the statistics in mean_path/std_path.
+    Shards are seeded from (seed, shard index), so the output doesn't depend on the number of workers.
+    """
+    if output_format not in ('raw', 'preprocessed'):
+        raise ValueError(f'Unknown output format: {output_format}')
+    os.makedirs(output_dir, exist_ok=True)
+    mean, std = (torch.load(mean_path), torch.load(std_path)) if output_format == 'preprocessed' else (None, None)
+    num_shards = (num_companies + companies_per_shard - 1) // companies_per_shard
+    tasks = [
+        (shard_index, min(companies_per_shard, num_companies - shard_index * companies_per_shard), output_dir, output_format, seed, max_years, missing_rate, outlier_rate, mean, std)
+        for shard_index in range(num_shards)
+    ]
+    paths = []
+    with Pool(workers) as pool:
+        for path in pool.imap_unordered(_generate_shard, tasks):
+            paths.append(path)
+            print(f'Wrote {path} ({len(paths)}/{num_shards})')
+    return sorted(paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic financial statements in the merged FMP format or the preprocessed format.')
+    parser.add_argument('--companies', type=int, default=10000)
+    parser.add_argument('--output-dir', default='data')
+    parser.add_argument('--format', choices=['raw', 'preprocessed'], default='raw')
+    parser.add_argument('--companies-per-shard', type=int, default=COMPANIES_PER_SHARD)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-years', type=int, default=MAX_YEARS)
+    parser.add_argument('--missing-rate', type=float, default=MISSING_RATE)
+    parser.add_argument('--outlier-rate', type=float, default=OUTLIER_RATE)
+    args = parser.parse_args()
+
+    generate(args.companies, args.output_dir, args.format, args.companies_per_shard, args.workers, args.seed, args.max_years, args.missing_rate, args.outlier_rate)
@@ -1,4 +1,7 @@
+import glob
 import json
+import os
+import re
 import torch
 
 FIELDS_AND_LIMITS = {
@@ -108,62 +111,93 @@ FIELDS_AND_LIMITS = {
 def nanstd(x): 
     return torch.sqrt(torch.mean(torch.pow(x-torch.nanmean(x,dim=1).unsqueeze(-1),2)))
 
-def niceify_data():
-    financial_statements = {}
-    for i in range(26):
-        with open(f'data/full_reports_{i}.json', 'r+') as file:
-            to_add = json.load(file)
-            financial_statements = {**financial_statements, **to_add}
+CURRENCY_INDICES = {"USD": 0, "EUR": 1, "CAD": 2, "CNY": 3, "IDR": 4, "AUD": 5, "ILS": 6, "GBP": 7, "DKK": 8, "BRL": 9, "NOK": 10, "PHP": 11, "SEK": 12, "TWD": 13, "CHF": 14, "TRY": 15, "NZD": 16, "SGD": 17, "JPY": 18, "HKD": 19, "NGN": 20, "ZAR": 21, "PEN": 22, "MYR": 23, "THB": 24, "CLP": 26, "PLN": 27, "MXN": 28, "NIS": 29, "SAR": 30, "PGK": 31, "COP": 32, "INR": 33, "ARS": 34, "GEL": 35, "GHS": 36, "CZK": 37, "EGP": 38, "RON": 39, "HUF": 40, "RUB": 41, "KRW": 42, "KZT": 43, "NAD": 44, "VND": 45}
+CURRENCY_EXCHANGE_RATES = {"USD": 1.0, "EUR": 0.93, "CAD": 1.37, "CNY": 7.24, "IDR": 15865.0, "AUD": 1.52, "ILS": 3.74, "GBP": 0.8, "DKK": 6.97, "BRL": 4.95, "NOK": 10.85, "PHP": 57.68, "SEK": 10.57, "TWD": 32.45, "CHF": 0.91, "TRY": 32.24, "NZD": 1.65, "SGD": 1.35, "JPY": 151.64, "HKD": 7.82, "NGN": 1487.96, "ZAR": 18.96, "PEN": 3.72, "MYR": 4.77, "THB": 36.26, "CLP": 971.46, "PLN": 4.02, "MXN": 17.06, "NIS": 3.74, "SAR": 3.75, "PGK": 3.8, "COP": 3918.96, "INR": 83.5, "ARS": 879.65, "GEL": 2.68, "GHS": 13.89, "CZK": 23.47, "EGP": 47.6, "RON": 4.64, "HUF": 366.1, "RUB": 91.62, "KRW": 1334.42, "KZT": 450.82, "NAD": 18.96, "VND": 24535.0}
+RATIO_FIELDS = ['grossProfitRatio', 'ebitdaratio', 'operatingIncomeRatio', 'incomeBeforeTaxRatio', 'netIncomeRatio']
+TO_NOT_SCALE_WITH_EXCHANGE_RATE = set(['calendarYear', 'reportedCurrency'] + RATIO_FIELDS)
+SHARD_FILE = 'shard_{:05d}.pt'
+REPORTS_PATTERN = 'data/full_reports_*.json'
 
-    # Count field occurrences
-    all_fields_counter = {}
-    # financial_statements = dict(islice(financial_statements.items(), 5))
-    # fields = [key for key, value in next(iter(financial_statements.values()))[0].items() if isinstance(value, (int, float))] + ["calendarYear", "reportedCurrency"]
+
+def get_statement_vectors(company_statements):
+    """
+    Converts the merged statements of one company (newest first) into vectors in FIELDS_AND_LIMITS order, in USD,
+    with missing and out-of-limit values set to -0.01. Stops at the first statement before 2000.
+
+    Returns:
+        tuple: (list of vectors, number of out-of-limit values)
+    """
+    list_statements = []
+    invalid_counter = 0
+    for statement in company_statements:
+        if float(statement['calendarYear']) < 2000:
+            break
+        currency = statement['reportedCurrency']
+        if currency not in CURRENCY_INDICES:
+            continue
+        statement['reportedCurrency'] = CURRENCY_INDICES[currency] + 1
+        vector = []
+        for field, limit in FIELDS_AND_LIMITS.items():
+            value = statement[field]
+            try:
+                value = float(value)
+            except:
+                value = -0.01
+            if field not in TO_NOT_SCALE_WITH_EXCHANGE_RATE:
+                value = value / CURRENCY_EXCHANGE_RATES[currency]
+            
+            if limit is not None and (value < limit[0] or value > limit[1]):
+                invalid_counter += 1
+                value = -0.01
+
+            vector.append(value)
+        list_statements.append(vector)
+    return list_statements, invalid_counter
+
+
+def normalize_reports(reports, mean, std):
+    """z-scores one company's (years, fields) tensor, keeping 0 for zero values and -0.01 for invalid ones, and flips it to oldest first."""
+    mask_invalid = reports == -0.01
+    mask_zero = reports == 0
+    reports[mask_invalid] = float('nan')
+    reports[mask_zero] = float('inf')
+    reports = (reports - mean) / std
+    reports = torch.nan_to_num(reports, nan=-0.01, posinf=0.0, neginf=0.0)
+    return reports.flip(dims=(0,))
+
+
+def save_shard(normalized_data, directory, shard_index):
+    """Writes one shard of the preprocessed dataset: a list of (years, fields) tensors, one per company, as in full_data.pt."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, SHARD_FILE.format(shard_index))
+    torch.save(normalized_data, path)
+    return path
+
+
+def get_report_paths(pattern=REPORTS_PATTERN):
+    """Every merged report file matching pattern, in the order merge_financial_statements.py wrote them."""
+    return sorted(glob.glob(pattern), key=lambda path: int(re.findall(r'\d+', os.path.basename(path))[-1]))
+
+
+def niceify_data(financial_statements=None, save=True, report_paths=None):
+    if financial_statements is None:
+        financial_statements = {}
+        for path in report_paths or get_report_paths():
+            with open(path, 'r+') as file:
+                to_add = json.load(file)
+                financial_statements = {**financial_statements, **to_add}
 
     data = []
-    currency_indices = {"USD": 0, "EUR": 1, "CAD": 2, "CNY": 3, "IDR": 4, "AUD": 5, "ILS": 6, "GBP": 7, "DKK": 8, "BRL": 9, "NOK": 10, "PHP": 11, "SEK": 12, "TWD": 13, "CHF": 14, "TRY": 15, "NZD": 16, "SGD": 17, "JPY": 18, "HKD": 19, "NGN": 20, "ZAR": 21, "PEN": 22, "MYR": 23, "THB": 24, "CLP": 26, "PLN": 27, "MXN": 28, "NIS": 29, "SAR": 30, "PGK": 31, "COP": 32, "INR": 33, "ARS": 34, "GEL": 35, "GHS": 36, "CZK": 37, "EGP": 38, "RON": 39, "HUF": 40, "RUB": 41, "KRW": 42, "KZT": 43, "NAD": 44, "VND": 45}
-    currency_exchange_rates = {"USD": 1.0, "EUR": 0.93, "CAD": 1.37, "CNY": 7.24, "IDR": 15865.0, "AUD": 1.52, "ILS": 3.74, "GBP": 0.8, "DKK": 6.97, "BRL": 4.95, "NOK": 10.85, "PHP": 57.68, "SEK": 10.57, "TWD": 32.45, "CHF": 0.91, "TRY": 32.24, "NZD": 1.65, "SGD": 1.35, "JPY": 151.64, "HKD": 7.82, "NGN": 1487.96, "ZAR": 18.96, "PEN": 3.72, "MYR": 4.77, "THB": 36.26, "CLP": 971.46, "PLN": 4.02, "MXN": 17.06, "NIS": 3.74, "SAR": 3.75, "PGK": 3.8, "COP": 3918.96, "INR": 83.5, "ARS": 879.65, "GEL": 2.68, "GHS": 13.89, "CZK": 23.47, "EGP": 47.6, "RON": 4.64, "HUF": 366.1, "RUB": 91.62, "KRW": 1334.42, "KZT": 450.82, "NAD": 18.96, "VND": 24535.0}
     all_financial_statements = []
-    ratio_fields = ['grossProfitRatio', 'ebitdaratio', 'operatingIncomeRatio', 'incomeBeforeTaxRatio', 'netIncomeRatio']
-    to_not_scale_with_exchange_rate = set(['calendarYear', 'reportedCurrency'] + ratio_fields)
     invalid_counter = 0
     general_counter = 0
-    for company_statements in financial_statements.values():
+    for ticker, company_statements in financial_statements.items():
         general_counter += 1
-        list_statements = []
-        is_valid = True
-        for statement in company_statements:
-            if float(statement['calendarYear']) < 2000:
-                break
-            currency = statement['reportedCurrency']
-            if currency not in currency_indices:
-                continue
-            statement['reportedCurrency'] = currency_indices[currency] + 1
-            vector = []
-            for field, limit in FIELDS_AND_LIMITS.items():
-                value = statement[field]
-                try:
-                    value = float(value)
-                except:
-                    value = -0.01
-                if field not in to_not_scale_with_exchange_rate:
-                    value = value / currency_exchange_rates[currency]
-                
-                if limit is not None and (value < limit[0] or value > limit[1]):
-                    # is_valid = False
-                    invalid_counter += 1
-                    value = -0.01
-                    # break
-
-                vector.append(value)
-            if not is_valid:
-                break
-            list_statements.append(vector)
-        if not is_valid:
-            continue
+        list_statements, company_invalid_counter = get_statement_vectors(company_statements)
+        invalid_counter += company_invalid_counter
         all_financial_statements += list_statements
         list_statements = torch.tensor(list_statements)
-        data.append(list_statements)
+        data.append((ticker, list_statements))
 
     all_financial_statements = torch.tensor(all_financial_statements)
     all_financial_statements = torch.nan_to_num(all_financial_statements, nan=0.0, posinf=0.0, neginf=0.0)
@@ -173,28 +207,25 @@ def niceify_data():
     mean = torch.cat((mean, torch.tensor(0).unsqueeze(0)), -1)
 
     normalized_data = []
-    for reports in data:
+    # Ticker of every company of normalized_data, the stable identity of a company across rebuilds
+    tickers = []
+    for ticker, reports in data:
         if reports.shape[0] == 0:
             continue
-        mask_invalid = reports == -0.01
-        mask_zero = reports == 0
-        # if (torch.numel(reports[~mask]) > torch.numel(reports) * 0.3):
-        #     continue
-        reports[mask_invalid] = float('nan')
-        reports[mask_zero] = float('inf')
-        reports = (reports - mean) / std
-        reports = torch.nan_to_num(reports, nan=-0.01, posinf=0.0, neginf=0.0)
-        reports = reports.flip(dims=(0,))
-        normalized_data.append(reports)
+        normalized_data.append(normalize_reports(reports, mean, std))
+        tickers.append(ticker)
 
     print(f'Share of invalid data: {invalid_counter/general_counter}')
-    torch.save(std, 'std.pt')
-    torch.save(mean, 'mean.pt')
-    torch.save(normalized_data, 'full_data.pt')
-    torch.save(currency_indices, 'currency_indices.pt')
-    torch.save(currency_exchange_rates, 'currency_exchange_rates.pt')
+    if save:
+        torch.save(std, 'std.pt')
+        torch.save(mean, 'mean.pt')
+        torch.save(normalized_data, 'full_data.pt')
+        torch.save(tickers, 'tickers.pt')
+        torch.save(CURRENCY_INDICES, 'currency_indices.pt')
+        torch.save(CURRENCY_EXCHANGE_RATES, 'currency_exchange_rates.pt')
 
     return normalized_data
 
 
-niceify_data()
\ No newline at end of file
+if __name__ == '__main__':
+    niceify_data()
@@ -0,0 +1,173 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+from itertools import groupby
+import torch
+
+from helpers.niceify_data import SHARD_FILE, get_statement_vectors, normalize_reports, save_shard
+
+DATABASE_PATH = 'data/statements.sqlite'
+STATEMENT_TABLES = ['income_statements', 'balance_sheets', 'cash_flow_statements']
+COMPANIES_PER_SHARD = 1000
+SQLITE_MAX_VARIABLES = 900
+
+
+def connect(path=DATABASE_PATH):
+    """
+    Opens (and creates if needed) the statements database: one table per statement type, indexed on (ticker, calendarYear),
+    plus the assignment of tickers to preprocessed shards.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    for table in STATEMENT_TABLES:
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (ticker TEXT NOT NULL, calendarYear TEXT NOT NULL, data TEXT NOT NULL)')
+        # As in merge_financial_statements.py, the last balance sheet / cash flow statement of a year wins, while every income statement is kept
+        unique = '' if table == 'income_statements' else 'UNIQUE'
+        connection.execute(f'CREATE {unique} INDEX IF NOT EXISTS {table}_ticker_year ON {table} (ticker, calendarYear)')
+    connection.execute('CREATE TABLE IF NOT EXISTS shard_assignments (ticker TEXT PRIMARY KEY, shard INTEGER NOT NULL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS shard_assignments_shard ON shard_assignments (shard)')
+    connection.commit()
+    return connection
+
+
+def _chunks(items, size=SQLITE_MAX_VARIABLES):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_statements(connection, table, statements:dict):
+    """
+    Replaces the statements of every ticker in `statements` ({ticker: [statement, ...]}, as fetched from FMP).
+    Returns the tickers whose statements changed.
+    """
+    if table not in STATEMENT_TABLES:
+        raise ValueError(f'Unknown statement table: {table}')
+    changed = set()
+    for tickers in _chunks(statements):
+        placeholders = ','.join('?' * len(tickers))
+        existing = {}
+        for ticker, data in connection.execute(f'SELECT ticker, data FROM {table} WHERE ticker IN ({placeholders}) ORDER BY rowid', tickers):
+            existing.setdefault(ticker, []).append(data)
+        rows = []
+        for ticker in tickers:
+            new_rows = [(ticker, str(statement['calendarYear']), json.dumps(statement)) for statement in statements[ticker] or []]
+            if table != 'income_statements':
+                # Only the last statement of a year is stored, compare against what will actually be stored
+                new_rows = list({row[1]: row for row in new_rows}.values())
+            if existing.get(ticker, []) != [data for _, _, data in new_rows]:
+                changed.add(ticker)
+                rows += new_rows
+        changed_tickers = [ticker for ticker in tickers if ticker in changed]
+        if changed_tickers:
+            connection.execute(f'DELETE FROM {table} WHERE ticker IN ({",".join("?" * len(changed_tickers))})', changed_tickers)
+            connection.executemany(f'INSERT OR REPLACE INTO {table} (ticker, calendarYear, data) VALUES (?, ?, ?)', rows)
+    connection.commit()
+    return changed
+
+
+def iter_merged_statements(connection, tickers=None):
+    """
+    Streams (ticker, [merged statement, ...]) in the order merge_financial_statements.py emits them, from one indexed join
+    of the three statement tables, optionally restricted to `tickers`.
+    """
+    restriction = ''
+    if tickers is not None:
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected_tickers (ticker TEXT PRIMARY KEY)')
+        connection.execute('DELETE FROM selected_tickers')
+        connection.executemany('INSERT OR IGNORE INTO selected_tickers VALUES (?)', [(ticker,) for ticker in tickers])
+        restriction = 'WHERE i.ticker IN (SELECT ticker FROM selected_tickers)'
+    rows = connection.execute(f'''
+        SELECT i.ticker, i.data, b.data, c.data
+        FROM income_statements i
+        JOIN balance_sheets b ON b.ticker = i.ticker AND b.calendarYear = i.calendarYear
+        JOIN cash_flow_statements c ON c.ticker = i.ticker AND c.calendarYear = i.calendarYear
+        {restriction}
+        ORDER BY i.rowid
+    ''')
+    for ticker, ticker_rows in groupby(rows, key=lambda row: row[0]):
+        yield ticker, [{**json.loads(income_statement), **json.loads(balance_sheet), **json.loads(cash_flow)} for _, income_statement, balance_sheet, cash_flow in ticker_rows]
+
+
+def write_merged_reports(connection, tickers=None, batch_size=COMPANIES_PER_SHARD, output_pattern='data/full_reports_{}.json'):
+    """Writes the merged statements in batches of batch_size tickers, like merge_financial_statements.py, one batch in memory at a time."""
+    paths = []
+    batch = {}
+    for ticker, statements in iter_merged_statements(connection, tickers):
+        batch[ticker] = statements
+        if len(batch) == batch_size:
+            paths.append(_dump_reports(batch, output_pattern.format(len(paths))))
+            batch = {}
+    if batch:
+        paths.append(_dump_reports(batch, output_pattern.format(len(paths))))
+    return paths
+
+
+def _dump_reports(reports, path):
+    with open(path, 'w+') as file:
+        json.dump(reports, file, indent=2)
+    return path
+
+
+def update_shards(connection, directory, mean, std, changed_tickers=None, companies_per_shard=COMPANIES_PER_SHARD):
+    """
+    Rewrites the preprocessed shards holding changed_tickers (all of them when None). Tickers seen for the first time are
+    appended to new shards, so the cost is proportional to the number of shards touched by the update.
+    Refuses to write into a directory holding shards it didn't write (e.g. from streaming.write_shards or the synthetic
+    data generator), since the streaming trainer would read them all.
+    """
+    if changed_tickers is None:
+        changed_tickers = [ticker for ticker, in connection.execute('SELECT DISTINCT ticker FROM income_statements ORDER BY rowid')]
+    changed_tickers = list(changed_tickers)
+
+    assigned = {}
+    for tickers in _chunks(changed_tickers):
+        rows = connection.execute(f'SELECT ticker, shard FROM shard_assignments WHERE ticker IN ({",".join("?" * len(tickers))})', tickers)
+        assigned.update(rows)
+    new_tickers = [ticker for ticker in changed_tickers if ticker not in assigned]
+    next_shard = connection.execute('SELECT COALESCE(MAX(shard) + 1, 0) FROM shard_assignments').fetchone()[0]
+    known_paths = {os.path.join(directory, SHARD_FILE.format(shard)) for shard, in connection.execute('SELECT DISTINCT shard FROM shard_assignments')}
+    unknown_paths = sorted(set(glob.glob(os.path.join(directory, SHARD_FILE.replace('{:05d}', '*')))) - known_paths)
+    if unknown_paths:
+        raise ValueError(f'{directory} holds {len(unknown_paths)} shards not written from this database (e.g. {unknown_paths[0]}), use another directory or remove them')
+    connection.executemany('INSERT INTO shard_assignments VALUES (?, ?)', [(ticker, next_shard + index // companies_per_shard) for index, ticker in enumerate(new_tickers)])
+    connection.commit()
+
+    shards = sorted(set(assigned.values()) | {next_shard + index // companies_per_shard for index in range(len(new_tickers))})
+    paths = []
+    for shard in shards:
+        shard_tickers = [ticker for ticker, in connection.execute('SELECT ticker FROM shard_assignments WHERE shard = ? ORDER BY rowid', (shard,))]
+        normalized_data = []
+        for _, statements in iter_merged_statements(connection, shard_tickers):
+            vectors, _ = get_statement_vectors(statements)
+            if len(vectors) > 0:
+                normalized_data.append(normalize_reports(torch.tensor(vectors), mean, std))
+        paths.append(save_shard(normalized_data, directory, shard))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads (re)fetched statements into the SQLite store and updates the merged output for the tickers that changed.')
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--income-statements', default='data/income_statements.json')
+    parser.add_argument('--balance-sheets', default='data/balance_sheets.json')
+    parser.add_argument('--cash-flow-statements', default='data/cash_flow_statements.json')
+    parser.add_argument('--format', choices=['raw', 'shards'], default='shards')
+    parser.add_argument('--shard-dir', default='shards')
+    args = parser.parse_args()
+
+    connection = connect(args.database)
+    changed = set()
+    for table, path in zip(STATEMENT_TABLES, [args.income_statements, args.balance_sheets, args.cash_flow_statements]):
+        with open(path, 'r') as file:
+            changed |= load_statements(connection, table, json.load(file))
+    print(f'{len(changed)} tickers changed')
+
+    if args.format == 'raw':
+        # niceify_data reads the full universe, so the raw output is always complete
+        write_merged_reports(connection)
+    else:
+        update_shards(connection, args.shard_dir, torch.load('mean.pt'), torch.load('std.pt'), changed_tickers=changed)
+    connection.close()
@@ -0,0 +1,200 @@
+import torch
+from torch.nn import functional as F
+
+from forecast import get_last_windows
+from scoring import load_tickers
+from train import DEVICE, INPUT_FIELDS, OUTPUT_VECTOR_FIELDS, MaskedNet, load_checkpoint
+
+PEER_INDEX_PATH = 'peer_index.pt'
+EMBEDDING_BATCH_SIZE = 8192
+SEARCH_BLOCK_SIZE = 65536
+IVF_ITERATIONS = 10
+
+
+def get_embeddings(model, windows, batch_size=EMBEDDING_BATCH_SIZE, device=DEVICE):
+    """
+    L2-normalized hidden representations of the windows: the values output of the last MaskedLayer, i.e. what the final
+    Linear head sees. (companies, hidden_size) contiguous matrix.
+    """
+    model.eval()
+    captured = []
+    head = model.lm_head.layers[-1]
+    handle = head.register_forward_pre_hook(lambda module, inputs: captured.append(inputs[0].detach().cpu()))
+    try:
+        with torch.no_grad():
+            for start in range(0, windows.shape[0], batch_size):
+                model(windows[start:start + batch_size].flatten(1).to(device))
+    finally:
+        handle.remove()
+    return F.normalize(torch.cat(captured), dim=1).contiguous()
+
+
+class PeerIndex:
+    """
+    Cosine-similarity nearest neighbours over company embeddings, stored in one contiguous matrix.
+    Companies are identified by ticker, as in scoring.py.
+    Search is exact (blocked matmul + top-k) by default. After build_ivf(), the embeddings are also kept grouped by
+    k-means list (inverted lists, contiguous in list_matrix), and queries only score the lists of their nprobe closest
+    centroids, each probed list being scored once against all the queries probing it.
+    update() overwrites re-scored companies in place, appends new ones and regroups the lists.
+    """
+    def __init__(self, dim):
+        self.matrix = torch.empty(0, dim)
+        self.size = 0
+        self.ids = []
+        self.rows = {}
+        self.centroids = None
+        self.assignments = torch.empty(0, dtype=torch.long)
+        # Inverted lists: rows sorted by list, list i being list_rows[list_offsets[i]:list_offsets[i + 1]]
+        self.list_rows = None
+        self.list_offsets = None
+        self.list_matrix = None
+
+    def update(self, company_ids, embeddings):
+        embeddings = F.normalize(embeddings.float(), dim=1)
+        new_ids = [company_id for company_id in dict.fromkeys(company_ids) if company_id not in self.rows]
+        if self.size + len(new_ids) > self.matrix.shape[0]:
+            # Grow geometrically so that incremental appends stay amortized O(1) per company
+            capacity = max(self.size + len(new_ids), 2 * self.matrix.shape[0], 1024)
+            matrix = torch.empty(capacity, self.matrix.shape[1])
+            matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+            assignments = torch.zeros(capacity, dtype=torch.long)
+            assignments[:self.size] = self.assignments[:self.size]
+            self.assignments = assignments
+        for company_id in new_ids:
+            self.rows[company_id] = self.size
+            self.ids.append(company_id)
+            self.size += 1
+
+        rows = torch.tensor([self.rows[company_id] for company_id in company_ids], dtype=torch.long)
+        self.matrix[rows] = embeddings
+        if self.centroids is not None:
+            self.assignments[rows] = (embeddings @ self.centroids.T).argmax(dim=1)
+            self._build_lists()
+
+    def _build_lists(self):
+        assignments = self.assignments[:self.size]
+        self.list_rows = torch.argsort(assignments, stable=True)
+        counts = torch.bincount(assignments, minlength=self.centroids.shape[0])
+        self.list_offsets = torch.cat((torch.zeros(1, dtype=torch.long), counts.cumsum(0))).tolist()
+        self.list_matrix = self.matrix[self.list_rows]
+
+    def build_ivf(self, num_lists, iterations=IVF_ITERATIONS, seed=42):
+        """Spherical k-means over the current embeddings, used by search() when nprobe is given."""
+        embeddings = self.matrix[:self.size]
+        generator = torch.Generator().manual_seed(seed)
+        centroids = embeddings[torch.randperm(self.size, generator=generator)[:num_lists]].clone()
+        for _ in range(iterations):
+            assignments = (embeddings @ centroids.T).argmax(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, embeddings)
+            # Empty lists keep their previous centroid
+            centroids = torch.where(sums.norm(dim=1, keepdim=True) > 0, F.normalize(sums, dim=1), centroids)
+        self.centroids = centroids
+        self.assignments[:self.size] = (embeddings @ centroids.T).argmax(dim=1)
+        self._build_lists()
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        Top-k most similar companies for every (normalized) query embedding.
+
+        Returns:
+            tuple: ((queries, k) cosine similarities, list of lists of company ids). When the probed lists hold fewer
+            than k companies, the remaining similarities are -inf and their ids None.
+        """
+        queries = F.normalize(queries.float(), dim=1)
+        if nprobe is not None and self.centroids is not None:
+            return self._search_ivf(queries, k, nprobe)
+
+        k = min(k, self.size)
+        best_scores = torch.full((queries.shape[0], 0), float('-inf'))
+        best_rows = torch.empty((queries.shape[0], 0), dtype=torch.long)
+        for start in range(0, self.size, SEARCH_BLOCK_SIZE):
+            block_scores = queries @ self.matrix[start:min(start + SEARCH_BLOCK_SIZE, self.size)].T
+            block_scores, block_rows = block_scores.topk(min(k, block_scores.shape[1]), dim=1)
+            best_scores, order = torch.cat((best_scores, block_scores), dim=1).topk(k, dim=1)
+            best_rows = torch.cat((best_rows, block_rows + start), dim=1).gather(1, order)
+        return best_scores, [[self.ids[row] for row in query_rows] for query_rows in best_rows.tolist()]
+
+    def _search_ivf(self, queries, k, nprobe):
+        k = min(k, self.size)
+        nprobe = min(nprobe, self.centroids.shape[0])
+        probes = (queries @ self.centroids.T).topk(nprobe, dim=1).indices
+        best_scores = torch.full((queries.shape[0], k), float('-inf'))
+        best_rows = torch.full((queries.shape[0], k), -1, dtype=torch.long)
+
+        # (query, list) pairs grouped by list, so that each probed list is one matmul against the queries probing it
+        probed_lists = probes.flatten()
+        order = torch.argsort(probed_lists, stable=True)
+        probing_queries = torch.arange(queries.shape[0]).repeat_interleave(nprobe)[order]
+        lists, counts = torch.unique_consecutive(probed_lists[order], return_counts=True)
+        for list_index, query_indices in zip(lists.tolist(), probing_queries.split(counts.tolist())):
+            start, end = self.list_offsets[list_index], self.list_offsets[list_index + 1]
+            if start == end:
+                continue
+            scores, positions = (queries[query_indices] @ self.list_matrix[start:end].T).topk(min(k, end - start), dim=1)
+            scores = torch.cat((best_scores[query_indices], scores), dim=1)
+            rows = torch.cat((best_rows[query_indices], self.list_rows[start + positions]), dim=1)
+            scores, best = scores.topk(k, dim=1)
+            best_scores[query_indices] = scores
+            best_rows[query_indices] = rows.gather(1, best)
+        return best_scores, [[self.ids[row] if row >= 0 else None for row in query_rows] for query_rows in best_rows.tolist()]
+
+    def peers(self, company_id, k=10, nprobe=None):
+        """The k companies most similar to company_id, excluding itself."""
+        scores, ids = self.search(self.matrix[self.rows[company_id]].unsqueeze(0), k + 1, nprobe)
+        return [(peer, float(score)) for peer, score in zip(ids[0], scores[0]) if peer is not None and peer != company_id][:k]
+
+    def save(self, path=PEER_INDEX_PATH):
+        torch.save({'matrix': self.matrix[:self.size].clone(), 'ids': self.ids, 'centroids': self.centroids, 'assignments': self.assignments[:self.size].clone()}, path)
+
+    @classmethod
+    def load(cls, path=PEER_INDEX_PATH):
+        state = torch.load(path)
+        index = cls(state['matrix'].shape[1])
+        index.matrix = state['matrix']
+        index.size = len(state['ids'])
+        index.ids = state['ids']
+        index.rows = {company_id: row for row, company_id in enumerate(index.ids)}
+        index.centroids = state['centroids']
+        index.assignments = state['assignments']
+        if index.centroids is not None:
+            index._build_lists()
+        return index
+
+
+def refresh_peer_index(index, model, windows, company_ids, rescored):
+    """
+    Re-embeds only the companies re-scored by scoring.score_incrementally (their input window changed) and updates the index.
+    company_ids are the tickers passed to score_incrementally.
+    """
+    if len(rescored) == 0:
+        return index
+    index.update([company_ids[i] for i in rescored.tolist()], get_embeddings(model, windows[rescored]))
+    return index
+
+
+def build_peer_index(model_path='test_model.pt', num_lists=None, path=PEER_INDEX_PATH):
+    full_dataset = torch.load('full_data.pt')
+    tickers = load_tickers(full_dataset)
+    windows, company_indices = get_last_windows(full_dataset)
+
+    model = MaskedNet(
+        input_size=3*len(INPUT_FIELDS),
+        output_size=len(OUTPUT_VECTOR_FIELDS),
+        number_of_currencies=47,
+    ).to(DEVICE)
+    model.load_state_dict(load_checkpoint(model_path, map_location=DEVICE))
+
+    embeddings = get_embeddings(model, windows)
+    index = PeerIndex(embeddings.shape[1])
+    index.update([tickers[company_index] for company_index in company_indices.tolist()], embeddings)
+    if num_lists:
+        index.build_ivf(num_lists)
+    index.save(path)
+    print(f'Indexed {index.size} companies, {embeddings.shape[1]}-dimensional embeddings')
+    return index
+
+
+if __name__ == '__main__':
+    build_peer_index()
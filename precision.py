@@ -0,0 +1,185 @@
+import os
+import torch
+from torch.utils.data import RandomSampler, TensorDataset
+
+from evaluation import evaluate
+
+INVALID_VALUE = -.01
+BIT_WEIGHTS = 2 ** torch.arange(8, dtype=torch.uint8)
+COMPRESS_CHUNK_ROWS = 65536
+
+
+def pack_bits(mask):
+    """(N, D) bool -> (N, ceil(D/8)) uint8, 8 mask values per byte."""
+    padding = (-mask.shape[-1]) % 8
+    mask = torch.cat((mask, torch.zeros(*mask.shape[:-1], padding, dtype=torch.bool)), dim=-1)
+    return (mask.view(*mask.shape[:-1], -1, 8).to(torch.uint8) * BIT_WEIGHTS).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_bits(packed, size):
+    bits = (packed.unsqueeze(-1) & BIT_WEIGHTS.to(packed.device)) != 0
+    return bits.view(*packed.shape[:-1], -1)[..., :size]
+
+
+def _compress_rows(values, dtype):
+    invalid = values == INVALID_VALUE
+    info = torch.finfo(dtype)
+    compact = values.clamp(info.min, info.max)
+    tiny = (compact != 0) & (compact.abs() < info.tiny)
+    compact = torch.where(tiny, torch.sign(compact) * info.tiny, compact).to(dtype)
+    compact[invalid] = 0
+    return compact, pack_bits(invalid)
+
+
+def compress(values, dtype=torch.bfloat16, chunk_rows=COMPRESS_CHUNK_ROWS):
+    """
+    Stores fp32 preprocessed values as (dtype values, bit-packed invalid mask).
+    -0.01 isn't representable in bf16/fp16, and nearby real values would round onto the same code, so the invalid sentinel
+    goes into its own mask channel. Zero stays the zero sentinel: real zeros are exact, and non-zero values that would
+    underflow to 0 are pushed to the smallest representable magnitude (and overflows clamped) so no zero appears or disappears.
+    Works chunk_rows rows at a time, so the fp32 temporaries stay small next to the input.
+    """
+    compact = torch.empty(values.shape, dtype=dtype)
+    packed_invalid = torch.empty(*values.shape[:-1], (values.shape[-1] + 7) // 8, dtype=torch.uint8)
+    for start in range(0, values.shape[0], chunk_rows):
+        compact[start:start + chunk_rows], packed_invalid[start:start + chunk_rows] = _compress_rows(values[start:start + chunk_rows], dtype)
+    return compact, packed_invalid
+
+
+def decompress(compact, packed_invalid):
+    """Upcasts back to fp32, restoring the exact -0.01 sentinel where the mask is set."""
+    values = compact.float()
+    invalid = unpack_bits(packed_invalid, values.shape[-1])
+    return values.masked_fill(invalid, INVALID_VALUE)
+
+
+def check_sentinels(values, dtype=torch.bfloat16):
+    """
+    Counts the values whose MaskedNet masks (== -.01, == 0) change through a plain cast round trip and through compress/decompress.
+
+    Returns:
+        dict: {'plain': {'invalid': mismatches, 'zero': mismatches}, 'compressed': {...}}
+    """
+    invalid, zero = values == INVALID_VALUE, values == 0
+    plain = values.to(dtype).float()
+    restored = decompress(*compress(values, dtype))
+    return {
+        name: {'invalid': int(((round_trip == INVALID_VALUE) != invalid).sum()), 'zero': int(((round_trip == 0) != zero).sum())}
+        for name, round_trip in (('plain', plain), ('compressed', restored))
+    }
+
+
+class CompactWindowBuilder:
+    """
+    Stands in for the list of windows of get_train_dataloader / get_val_dataloader: windows are compressed every
+    chunk_rows appends, so the full fp32 window tensor is never built.
+    """
+    def __init__(self, dtype=torch.bfloat16, chunk_rows=COMPRESS_CHUNK_ROWS):
+        self.dtype = dtype
+        self.chunk_rows = chunk_rows
+        self.pending = []
+        self.chunks = []
+
+    def append(self, window):
+        self.pending.append(window)
+        if len(self.pending) == self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.chunks.append(_compress_rows(torch.stack(self.pending), self.dtype))
+            self.pending = []
+
+    def finish(self):
+        """(compact windows, bit-packed invalid mask)"""
+        self._flush()
+        compact = torch.cat([compact for compact, _ in self.chunks])
+        packed_invalid = torch.cat([packed_invalid for _, packed_invalid in self.chunks])
+        self.chunks = []
+        return compact, packed_invalid
+
+
+class CompactDataset:
+    """Preprocessed dataset (list of per-company tensors, as in full_data.pt) kept compressed, decompressing companies as they're read."""
+    def __init__(self, companies):
+        self.companies = companies
+
+    @classmethod
+    def from_dataset(cls, full_dataset, dtype=torch.bfloat16):
+        return cls([compress(company_statements, dtype) for company_statements in full_dataset])
+
+    @classmethod
+    def load(cls, path='full_data.pt', dtype=torch.bfloat16):
+        """
+        Loads the compressed copy of the dataset at path, written next to it (full_data_bfloat16.pt, ...) the first time,
+        so that later runs never load the fp32 dataset.
+        """
+        compact_path = f'{os.path.splitext(path)[0]}_{str(dtype).split(".")[-1]}.pt'
+        if os.path.exists(compact_path) and os.path.getmtime(compact_path) >= os.path.getmtime(path):
+            return cls(torch.load(compact_path))
+        dataset = cls.from_dataset(torch.load(path), dtype)
+        torch.save(dataset.companies, compact_path)
+        return dataset
+
+    def __len__(self):
+        return len(self.companies)
+
+    def __getitem__(self, index):
+        return decompress(*self.companies[index])
+
+    def __iter__(self):
+        for compact, packed_invalid in self.companies:
+            yield decompress(compact, packed_invalid)
+
+    def nbytes(self):
+        return sum(compact.nbytes + packed_invalid.nbytes for compact, packed_invalid in self.companies)
+
+
+class CompactWindowLoader:
+    """
+    Drop-in replacement for the window DataLoaders of train.py, holding the windows compressed and upcasting one batch
+    at a time. Targets stay in fp32, they're a small fraction of the memory and go straight into the loss.
+    """
+    def __init__(self, compact, packed_invalid, targets, batch_size, shuffle=False):
+        self.dataset = TensorDataset(compact, packed_invalid, targets)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    @classmethod
+    def from_loader(cls, loader, dtype=torch.bfloat16):
+        inputs, targets = loader.dataset.tensors
+        return cls(*compress(inputs, dtype), targets, loader.batch_size, shuffle=isinstance(loader.sampler, RandomSampler))
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        compact, packed_invalid, targets = self.dataset.tensors
+        order = torch.randperm(len(self.dataset)) if self.shuffle else torch.arange(len(self.dataset))
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            yield decompress(compact[indices], packed_invalid[indices]), targets[indices]
+
+    def nbytes(self):
+        return sum(tensor.nbytes for tensor in self.dataset.tensors)
+
+
+def report_precision(model, val_loader, device, output_fields:list[str], input_fields:list[str], dtype=torch.bfloat16):
+    """Memory saved by storing the validation windows in dtype, sentinel round trip checks, and the validation loss difference."""
+    inputs, targets = val_loader.dataset.tensors
+    compact_loader = CompactWindowLoader.from_loader(val_loader, dtype)
+    full_loss = evaluate(model, val_loader, device, output_fields=output_fields, input_fields=input_fields, quantiles=None)['loss']
+    compact_loss = evaluate(model, compact_loader, device, output_fields=output_fields, input_fields=input_fields, quantiles=None)['loss']
+    full_bytes = inputs.nbytes + targets.nbytes
+    report = {
+        'dtype': str(dtype),
+        'full_bytes': full_bytes,
+        'compact_bytes': compact_loader.nbytes(),
+        'memory_saved': 1 - compact_loader.nbytes() / full_bytes,
+        'sentinel_mismatches': check_sentinels(inputs, dtype),
+        'full_val_loss': full_loss,
+        'compact_val_loss': compact_loss,
+        'val_loss_difference': compact_loss - full_loss,
+    }
+    print(f'{report["dtype"]}: {report["memory_saved"]:.1%} memory saved, Val Loss: {compact_loss:.4f} (fp32: {full_loss:.4f}), sentinel mismatches: {report["sentinel_mismatches"]}')
+    return report
@@ -0,0 +1,187 @@
+import statistics
+import time
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader, TensorDataset
+
+from attribution import get_attributions
+from evaluation import evaluate
+from train import (BATCH_SIZE, DEVICE, INPUT_FIELDS, LEARNING_RATE, NUM_INPUT_FIELDS, OUTPUT_VECTOR_FIELDS, WEIGHT_DECAY,
+                   MaskedNet, get_train_dataloader, get_val_dataloader, load_checkpoint, load_checkpoint_bundle, train_epoch)
+
+FINE_TUNE_EPOCHS = 5
+FINE_TUNE_LEARNING_RATE = LEARNING_RATE / 5
+ATTRIBUTION_SAMPLES = 20000
+LATENCY_BATCH_SIZE = 4096
+LATENCY_REPEATS = 20
+PRUNED_MODEL_PATH = 'pruned_model.pt'
+
+
+def rank_input_fields(attributions, input_fields:list[str]):
+    """
+    Input fields sorted from most to least important, scoring each field by its mean absolute attribution summed over
+    the years of the window, after scaling every output so that its most important field scores 1.
+    """
+    scores = attributions['abs_mean'].sum(dim=-1)  # (outputs, fields)
+    scores = scores / scores.max(dim=1, keepdim=True).values.clamp_min(1e-12)
+    scores = scores.sum(dim=0)
+    return [input_fields[index] for index in torch.argsort(scores, descending=True).tolist()]
+
+
+def select_input_fields(ranking, num_fields=NUM_INPUT_FIELDS, input_fields:list[str]=INPUT_FIELDS, output_fields:list[str]=OUTPUT_VECTOR_FIELDS):
+    """
+    Keeps the num_fields best ranked fields, always including the output fields (their last value is the carry-over
+    baseline) and reportedCurrency (the currency embedding index, which has to stay the last column). Keeps INPUT_FIELDS order.
+    """
+    required = list(dict.fromkeys(list(output_fields) + ['reportedCurrency']))
+    kept = set(required)
+    for field in ranking:
+        if len(kept) >= max(num_fields, len(required)):
+            break
+        kept.add(field)
+    return [field for field in input_fields if field in kept]
+
+
+def get_window_columns(kept_fields:list[str], input_fields:list[str]=INPUT_FIELDS, window_years=3):
+    """Columns of the flattened (year-major) window holding the kept fields."""
+    field_indices = [input_fields.index(field) for field in kept_fields]
+    return torch.tensor([year * len(input_fields) + index for year in range(window_years) for index in field_indices])
+
+
+def prune_model(model, kept_fields:list[str], input_fields:list[str]=INPUT_FIELDS, output_size=len(OUTPUT_VECTOR_FIELDS)):
+    """
+    Copies the model into a MaskedNet over kept_fields only, removing the other input columns from the first main_proj.
+    Hidden sizes and every other weight are kept as they are.
+    """
+    columns = get_window_columns(kept_fields, input_fields)
+    old_main_proj = model.lm_head.layers[0].main_proj.weight.detach()
+    old_input_size = old_main_proj.shape[1] - 1
+    # main_proj sees the window without its last column (the currency index), followed by the 2 currency embedding dimensions
+    main_proj_columns = torch.cat((columns[:-1], torch.tensor([old_input_size - 1, old_input_size])))
+
+    hidden_sizes = (model.lm_head.layers[0].out_features, model.lm_head.layers[1].out_features)
+    pruned = MaskedNet(
+        input_size=len(columns),
+        output_size=output_size,
+        number_of_currencies=model.currency_embedding.num_embeddings,
+        hidden_sizes=hidden_sizes,
+    )
+    state_dict = {key: value.clone() for key, value in model.state_dict().items()}
+    state_dict['lm_head.layers.0.main_proj.weight'] = old_main_proj[:, main_proj_columns].clone()
+    pruned.load_state_dict(state_dict)
+    return pruned.to(next(model.parameters()).device)
+
+
+def load_pruned_model(path=PRUNED_MODEL_PATH, device=DEVICE):
+    """
+    Rebuilds a model exported by prune() from its bundled hidden sizes and field lists.
+    Full windows are cut down to its inputs with windows[:, get_window_columns(input_fields)].
+
+    Returns:
+        tuple: (model, input_fields, output_fields)
+    """
+    state_dict, metadata = load_checkpoint_bundle(path, map_location=device)
+    input_fields, output_fields = metadata['input_fields'], metadata['output_fields']
+    model = MaskedNet(
+        input_size=len(get_window_columns(input_fields)),
+        output_size=len(output_fields),
+        number_of_currencies=state_dict['currency_embedding.weight'].shape[0],
+        hidden_sizes=tuple(metadata['hidden_sizes']),
+    ).to(device)
+    model.load_state_dict(state_dict)
+    return model.eval(), input_fields, output_fields
+
+
+def slice_loader(loader, columns, shuffle=False):
+    inputs, targets = loader.dataset.tensors
+    return DataLoader(TensorDataset(inputs[:, columns], targets), batch_size=loader.batch_size, shuffle=shuffle)
+
+
+def measure_latency(model, inputs, batch_size=LATENCY_BATCH_SIZE, repeats=LATENCY_REPEATS, device=DEVICE):
+    """Median seconds of one forward over a batch of batch_size windows."""
+    model.eval()
+    batch = inputs[torch.arange(batch_size) % inputs.shape[0]].to(device)
+    timings = []
+    with torch.no_grad():
+        model(batch)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(batch)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def prune(model_path='test_model.pt', num_fields=NUM_INPUT_FIELDS, fine_tune_epochs=FINE_TUNE_EPOCHS, output_path=PRUNED_MODEL_PATH):
+    """
+    Ranks the input fields of a trained model with gradient attributions, cuts the model down to the num_fields best ones,
+    fine-tunes it and exports it with its field lists. Returns a report comparing it to the full model.
+    """
+    output_field_indices = torch.tensor([INPUT_FIELDS.index(field) for field in OUTPUT_VECTOR_FIELDS])
+    full_dataset = torch.load('full_data.pt')
+    val_data_loader = get_val_dataloader(full_dataset=full_dataset, output_field_indices=output_field_indices, batch_size=BATCH_SIZE)
+    train_data_loader = get_train_dataloader(full_dataset=full_dataset, output_field_indices=output_field_indices, batch_size=BATCH_SIZE)
+
+    model = MaskedNet(
+        input_size=3*len(INPUT_FIELDS),
+        output_size=len(OUTPUT_VECTOR_FIELDS),
+        number_of_currencies=47,
+    ).to(DEVICE)
+    model.load_state_dict(load_checkpoint(model_path, map_location=DEVICE))
+
+    # Ranked on training windows, so that the validation set stays untouched for the comparison
+    attributions = get_attributions(model, train_data_loader, DEVICE, input_fields=INPUT_FIELDS, output_fields=OUTPUT_VECTOR_FIELDS, max_samples=ATTRIBUTION_SAMPLES)
+    ranking = rank_input_fields(attributions, INPUT_FIELDS)
+    kept_fields = select_input_fields(ranking, num_fields)
+    columns = get_window_columns(kept_fields)
+
+    pruned_model = prune_model(model, kept_fields)
+    pruned_train_loader = slice_loader(train_data_loader, columns, shuffle=True)
+    pruned_val_loader = slice_loader(val_data_loader, columns)
+    optimizer = optim.AdamW(pruned_model.parameters(), lr=FINE_TUNE_LEARNING_RATE, weight_decay=WEIGHT_DECAY)
+
+    full_metrics = evaluate(model, val_data_loader, DEVICE, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=INPUT_FIELDS, quantiles=None)
+    pruned_metrics = evaluate(pruned_model, pruned_val_loader, DEVICE, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=kept_fields, quantiles=None)
+    print(f'Pruned to {len(kept_fields)} fields before fine-tuning: Val Loss: {pruned_metrics["loss"]:.4f}, Full model: {full_metrics["loss"]:.4f}')
+    best_val_loss = pruned_metrics['loss']
+    best_state_dict = {key: value.clone() for key, value in pruned_model.state_dict().items()}
+    for epoch in range(fine_tune_epochs):
+        train_loss = train_epoch(pruned_model, pruned_train_loader, optimizer, DEVICE)
+        val_loss = evaluate(pruned_model, pruned_val_loader, DEVICE, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=kept_fields, quantiles=None)['loss']
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            best_state_dict = {key: value.clone() for key, value in pruned_model.state_dict().items()}
+        print(f'Fine-tuning epoch {epoch}: Train Loss: {train_loss:.4f}, Val Loss: {val_loss:.4f}, Best VL: {best_val_loss:.4f}')
+    pruned_model.load_state_dict(best_state_dict)
+
+    pruned_metrics = evaluate(pruned_model, pruned_val_loader, DEVICE, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=kept_fields, quantiles=None)
+    torch.save({
+        'state_dict': pruned_model.state_dict(),
+        'input_fields': kept_fields,
+        'output_fields': OUTPUT_VECTOR_FIELDS,
+        'hidden_sizes': (pruned_model.lm_head.layers[0].out_features, pruned_model.lm_head.layers[1].out_features),
+    }, output_path)
+
+    full_latency = measure_latency(model, val_data_loader.dataset.tensors[0])
+    pruned_latency = measure_latency(pruned_model, pruned_val_loader.dataset.tensors[0])
+    report = {
+        'kept_fields': kept_fields,
+        'full_val_loss': full_metrics['loss'],
+        'pruned_val_loss': pruned_metrics['loss'],
+        'per_field_val_loss': {field: (full_metrics['fields'][field]['loss'], pruned_metrics['fields'][field]['loss']) for field in OUTPUT_VECTOR_FIELDS},
+        'full_parameters': sum(p.numel() for p in model.parameters()),
+        'pruned_parameters': sum(p.numel() for p in pruned_model.parameters()),
+        'full_latency_s': full_latency,
+        'pruned_latency_s': pruned_latency,
+        # Fewer fields to fetch, convert and normalize per statement, and smaller windows to store
+        'preprocessed_fields_share': len(kept_fields) / len(INPUT_FIELDS),
+    }
+    print(f'Kept {len(kept_fields)}/{len(INPUT_FIELDS)} fields. Val Loss: {report["pruned_val_loss"]:.4f} (full: {report["full_val_loss"]:.4f}), '
+          f'latency per {LATENCY_BATCH_SIZE} windows: {pruned_latency*1000:.2f}ms (full: {full_latency*1000:.2f}ms), '
+          f'parameters: {report["pruned_parameters"]} (full: {report["full_parameters"]})')
+    return report
+
+
+if __name__ == '__main__':
+    prune()
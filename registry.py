@@ -0,0 +1,183 @@
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from pruning import get_window_columns
+from train import DEVICE, INPUT_FIELDS, OUTPUT_VECTOR_FIELDS, MaskedLayer, MaskedNet, load_checkpoint_bundle
+
+# Checkpoints shipped with the repo and the fields they predict (None when unknown, outputs are then named by position)
+CHECKPOINTS = {
+    'test_model.pt': OUTPUT_VECTOR_FIELDS,
+    'net_income_and_stuff_model.pt': ["interestIncome", "interestExpense", "ebitda", "operatingIncome", "incomeBeforeTax", "netIncome", "eps", "epsdiluted"],
+    'revenue_model.pt': None,
+    'blog_post_model.pt': None,
+}
+
+
+def get_model_sizes(state_dict):
+    """Infers MaskedNet's (input_size, output_size, number_of_currencies, hidden_sizes) from a state_dict."""
+    layer_indices = sorted({int(key.split('.')[2]) for key in state_dict if key.startswith('lm_head.layers.')})
+    main_projs = [state_dict[f'lm_head.layers.{index}.main_proj.weight'] for index in layer_indices[:-1]]
+    last_layer = state_dict[f'lm_head.layers.{layer_indices[-1]}.weight']
+    # main_proj takes the features of the window without the currency column, plus the 2 currency embedding dimensions
+    hidden_sizes = tuple(main_proj.shape[0] for main_proj in main_projs)
+    return main_projs[0].shape[1] - 1, last_layer.shape[0], state_dict['currency_embedding.weight'].shape[0], hidden_sizes
+
+
+class FusedMaskedNets(nn.Module):
+    """
+    Several MaskedNets with the same input_size evaluated together: the masks are computed once, the first main_proj
+    of every model is one matmul against the concatenated weights, and every later layer is one batched matmul over models.
+    Final heads of different widths are zero-padded to the widest one.
+    """
+    def __init__(self, models):
+        super().__init__()
+        layers = [list(model.lm_head.layers) for model in models]
+        self.num_models = len(models)
+        self.output_sizes = [model_layers[-1].out_features for model_layers in layers]
+
+        # Zero rows for models trained with fewer currencies
+        embeddings = [model.currency_embedding.weight.detach() for model in models]
+        currency_embeddings = torch.zeros(self.num_models, max(embedding.shape[0] for embedding in embeddings), 2)
+        for index, embedding in enumerate(embeddings):
+            currency_embeddings[index, :embedding.shape[0]] = embedding
+        self.register_buffer('currency_embeddings', currency_embeddings)
+
+        main_proj = torch.stack([model_layers[0].main_proj.weight.detach() for model_layers in layers])  # (M, h, D + 2)
+        self.hidden_size = main_proj.shape[1]
+        self.register_buffer('first_main_proj', main_proj[:, :, :-2].reshape(-1, main_proj.shape[2] - 2).T.contiguous())  # (D, M*h)
+        self.register_buffer('first_embedding_proj', main_proj[:, :, -2:].transpose(1, 2).contiguous())  # (M, 2, h)
+
+        # Weights of every MaskedLayer, transposed and stacked over models: (M, in, out)
+        self.layer_configs = []
+        for depth in range(len(layers[0]) - 1):
+            stacked = [model_layers[depth] for model_layers in layers]
+            if depth > 0:
+                self.register_buffer(f'main_proj_{depth}', torch.stack([layer.main_proj.weight.detach().T for layer in stacked]))
+            self.register_buffer(f'result_proj_1_{depth}', torch.stack([layer.result_proj_1.weight.detach().T for layer in stacked]))
+            self.register_buffer(f'result_proj_2_{depth}', torch.stack([layer.result_proj_2.weight.detach().T for layer in stacked]))
+            self.register_buffer(f'bias_{depth}', torch.stack([layer.bias.detach() for layer in stacked]).unsqueeze(1))
+            self.layer_configs.append((stacked[0].out_features, stacked[0].leaky_relu.negative_slope))
+
+        max_output_size = max(self.output_sizes)
+        head_weight = torch.zeros(self.num_models, layers[0][-1].in_features, max_output_size)
+        head_bias = torch.zeros(self.num_models, 1, max_output_size)
+        for index, model_layers in enumerate(layers):
+            head_weight[index, :, :self.output_sizes[index]] = model_layers[-1].weight.detach().T
+            head_bias[index, 0, :self.output_sizes[index]] = model_layers[-1].bias.detach()
+        self.register_buffer('head_weight', head_weight)
+        self.register_buffer('head_bias', head_bias)
+
+    def forward(self, input):
+        """(B, input_size) window -> (num_models, B, widest output) predictions."""
+        batch_size = input.shape[0]
+        main_features = input[:, :-1]
+        currency_idx = input[:, -1].long()
+        mask_invalid = (main_features == -.01).float()
+        mask_zero = (main_features == 0).float()
+
+        # First layer: one matmul for the shared values and masks of every model, then each model's currency embedding term
+        first = torch.cat((main_features, mask_zero, mask_invalid)) @ self.first_main_proj
+        first = first.view(3, batch_size, self.num_models, self.hidden_size).permute(0, 2, 1, 3)  # (3, M, B, h)
+        currency_embedding = self.currency_embeddings[:, currency_idx]  # (M, B, 2)
+        values = first[0] + torch.bmm(currency_embedding, self.first_embedding_proj)
+        general_vector = torch.cat((values, first[1], first[2]), dim=-1)
+
+        for depth, (out_features, negative_slope) in enumerate(self.layer_configs):
+            if depth > 0:
+                # (M, 3B, h_in) @ (M, h_in, h_out), values and masks share the weights
+                projected = torch.bmm(torch.cat((values, mask_zero, mask_invalid), dim=1), getattr(self, f'main_proj_{depth}'))
+                general_vector = torch.cat(projected.split(batch_size, dim=1), dim=-1)
+            out = torch.bmm(torch.bmm(general_vector, getattr(self, f'result_proj_1_{depth}')), getattr(self, f'result_proj_2_{depth}'))
+            out = F.leaky_relu(out + getattr(self, f'bias_{depth}'), negative_slope)
+            values, mask_zero, mask_invalid = out.split(out_features, dim=-1)
+
+        return torch.baddbmm(self.head_bias, values, self.head_weight)
+
+
+class ModelRegistry:
+    """
+    Loads every compatible MaskedNet checkpoint once, inferring its sizes from the state_dict, and answers requests for
+    any subset of fields with a single fused pass over the models that predict them. When several models predict the
+    same field, the first registered one is used. Pruned checkpoints (see pruning.prune) are served from full windows,
+    sliced down to their input fields.
+    """
+    def __init__(self, checkpoints=CHECKPOINTS, device=DEVICE):
+        self.device = device
+        self.models = {}
+        self.output_fields = {}
+        self.input_sizes = {}
+        self.input_columns = {}
+        self.hidden_sizes = {}
+        self.fused = {}
+        for path, output_fields in checkpoints.items():
+            self.register(path, output_fields)
+
+    def register(self, path, output_fields=None):
+        state_dict, metadata = load_checkpoint_bundle(path)
+        try:
+            input_size, output_size, number_of_currencies, hidden_sizes = get_model_sizes(state_dict)
+            model = MaskedNet(input_size=input_size, output_size=output_size, number_of_currencies=number_of_currencies, hidden_sizes=hidden_sizes)
+            model.load_state_dict(state_dict)
+        except (KeyError, IndexError, RuntimeError) as error:
+            print(f'Skipping {path}: not a MaskedNet checkpoint ({type(error).__name__}: {str(error).splitlines()[0]})')
+            return False
+        if not all(isinstance(layer, MaskedLayer) for layer in list(model.lm_head.layers)[:-1]):
+            print(f'Skipping {path}: unsupported layer layout')
+            return False
+
+        output_fields = output_fields or metadata.get('output_fields') or [f'{path}[{index}]' for index in range(output_size)]
+        if len(output_fields) != output_size:
+            raise ValueError(f'{path} has {output_size} outputs, got {len(output_fields)} output fields')
+        self.models[path] = model.to(self.device).eval()
+        self.output_fields[path] = list(output_fields)
+        # Pruned models only see the columns of their input fields, predict() slices full windows down to them
+        input_fields = metadata.get('input_fields')
+        self.input_columns[path] = get_window_columns(input_fields) if input_fields else None
+        self.input_sizes[path] = 3*len(INPUT_FIELDS) if input_fields else input_size
+        self.hidden_sizes[path] = hidden_sizes
+        self.fused = {}
+        return True
+
+    @property
+    def fields(self):
+        return list(dict.fromkeys(field for output_fields in self.output_fields.values() for field in output_fields))
+
+    def _get_fused(self, paths):
+        if paths not in self.fused:
+            self.fused[paths] = FusedMaskedNets([self.models[path] for path in paths]).to(self.device)
+        return self.fused[paths]
+
+    def predict(self, input, fields=None):
+        """
+        Predictions for the requested fields (all of them by default) from one fused forward over the models providing them.
+
+        Returns:
+            dict: {field: (B,) tensor}
+        """
+        fields = fields or self.fields
+        input_size = input.shape[1]
+        sources = {}
+        for field in fields:
+            path = next((path for path, output_fields in self.output_fields.items() if field in output_fields and self.input_sizes[path] == input_size), None)
+            if path is None:
+                raise KeyError(f'No registered model with input_size {input_size} predicts {field}')
+            sources[field] = path
+
+        # Models seeing the same columns with the same hidden sizes share one fused forward
+        groups = {}
+        for path in dict.fromkeys(sources.values()):
+            columns = self.input_columns[path]
+            groups.setdefault((None if columns is None else tuple(columns.tolist()), self.hidden_sizes[path]), []).append(path)
+        outputs = {}
+        with torch.no_grad():
+            for (columns, _), paths in groups.items():
+                group_input = input if columns is None else input[:, list(columns)]
+                group_outputs = self._get_fused(tuple(paths))(group_input.to(self.device))
+                outputs.update({path: group_outputs[index] for index, path in enumerate(paths)})
+        return {field: outputs[path][:, self.output_fields[path].index(field)] for field, path in sources.items()}
+
+
+if __name__ == '__main__':
+    registry = ModelRegistry()
+    print(f'Registered {", ".join(registry.models)}, serving {", ".join(registry.fields)}')
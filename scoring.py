@@ -0,0 +1,176 @@
+import hashlib
+import sqlite3
+import time
+import numpy as np
+import torch
+
+from forecast import get_last_windows
+from train import DEVICE, INPUT_FIELDS, OUTPUT_VECTOR_FIELDS, MaskedNet, load_checkpoint
+
+CACHE_PATH = 'prediction_cache.sqlite'
+SCORING_BATCH_SIZE = 8192
+MAX_CACHE_AGE = 30 * 24 * 3600  # seconds
+MAX_CACHE_ENTRIES = 1_000_000
+SQLITE_MAX_VARIABLES = 900
+
+
+def get_checkpoint_id(path):
+    """Identity of a checkpoint: hash of the file contents, so retraining into the same path invalidates cached predictions."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_window_keys(windows, checkpoint_id):
+    """One key per company, hashing its normalized input window (as float32 bytes) together with the checkpoint identity."""
+    window_bytes = windows.detach().to(torch.float32).contiguous().cpu().flatten(1).numpy()
+    prefix = checkpoint_id.encode()
+    return [hashlib.sha256(prefix + row.tobytes()).hexdigest() for row in window_bytes]
+
+
+class PredictionCache:
+    """
+    Persistent prediction cache in SQLite, keyed by get_window_keys, plus the key of the latest window of every company
+    (by ticker) for each checkpoint, rewritten on every run. WAL journaling lets any number of readers (e.g. dashboards
+    going through get_company_predictions) query it while a scoring run writes.
+    Entries older than max_age or beyond the max_entries most recently used are evicted by evict().
+    """
+    def __init__(self, path=CACHE_PATH, max_age=MAX_CACHE_AGE, max_entries=MAX_CACHE_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS predictions (
+            key TEXT PRIMARY KEY,
+            checkpoint_id TEXT NOT NULL,
+            prediction BLOB NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL
+        )''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS company_keys (
+            company TEXT NOT NULL,
+            checkpoint_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (company, checkpoint_id)
+        )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS company_keys_key ON company_keys (key)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_access ON predictions (last_access)')
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """Returns {key: prediction} for the keys found in the cache, and marks them as used."""
+        found = {}
+        now = time.time()
+        for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(f'SELECT key, prediction FROM predictions WHERE key IN ({placeholders}) AND created >= ?', (*chunk, now - self.max_age))
+            found.update({key: np.frombuffer(prediction, dtype=np.float32) for key, prediction in rows})
+            self.connection.execute(f'UPDATE predictions SET last_access = ? WHERE key IN ({placeholders})', (now, *chunk))
+        self.connection.commit()
+        return found
+
+    def put_many(self, keys, checkpoint_id, predictions):
+        now = time.time()
+        rows = [(key, checkpoint_id, prediction.astype(np.float32).tobytes(), now, now) for key, prediction in zip(keys, predictions)]
+        self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def set_company_keys(self, companies, keys, checkpoint_id):
+        """Points every company at the key of its current window, cached or not."""
+        now = time.time()
+        rows = [(str(company), checkpoint_id, key, now) for company, key in zip(companies, keys)]
+        self.connection.executemany('INSERT OR REPLACE INTO company_keys VALUES (?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def get_company_predictions(self, companies, checkpoint_id):
+        """Latest cached prediction of each company for a checkpoint, without touching the model."""
+        found = {}
+        for start in range(0, len(companies), SQLITE_MAX_VARIABLES):
+            chunk = [str(company) for company in companies[start:start + SQLITE_MAX_VARIABLES]]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f'SELECT c.company, p.prediction FROM company_keys c JOIN predictions p ON p.key = c.key WHERE c.checkpoint_id = ? AND c.company IN ({placeholders})',
+                (checkpoint_id, *chunk),
+            )
+            found.update({company: np.frombuffer(prediction, dtype=np.float32) for company, prediction in rows})
+        return found
+
+    def evict(self):
+        """Drops entries older than max_age, then the least recently used ones beyond max_entries. Returns the number of entries removed."""
+        removed = self.connection.execute('DELETE FROM predictions WHERE created < ?', (time.time() - self.max_age,)).rowcount
+        removed += self.connection.execute(
+            'DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,),
+        ).rowcount
+        self.connection.execute('DELETE FROM company_keys WHERE key NOT IN (SELECT key FROM predictions)')
+        self.connection.commit()
+        return removed
+
+    def close(self):
+        self.connection.close()
+
+
+def score_incrementally(model, windows, companies, checkpoint_id, cache, batch_size=SCORING_BATCH_SIZE, device=DEVICE):
+    """
+    Scores every company, only running the model on the windows missing from the cache, in batches of batch_size.
+    companies are the stable ids (tickers) the predictions are stored under for get_company_predictions.
+
+    Returns:
+        tuple: ((companies, outputs) normalized predictions, indices of the companies that were re-scored)
+    """
+    keys = get_window_keys(windows, checkpoint_id)
+    cached = cache.get_many(keys)
+    miss_indices = [index for index, key in enumerate(keys) if key not in cached]
+
+    model.eval()
+    predictions = {}
+    with torch.no_grad():
+        for start in range(0, len(miss_indices), batch_size):
+            batch_indices = miss_indices[start:start + batch_size]
+            output, _ = model(windows[batch_indices].flatten(1).to(device))
+            output = output.cpu().numpy()
+            cache.put_many([keys[i] for i in batch_indices], checkpoint_id, output)
+            predictions.update(zip(batch_indices, output))
+
+    cache.set_company_keys(companies, keys, checkpoint_id)
+    all_predictions = np.stack([cached[key] if key in cached else predictions[index] for index, key in enumerate(keys)])
+    cache.evict()
+    print(f'Scored {len(keys)} companies, {len(miss_indices)} cache misses')
+    return torch.from_numpy(all_predictions), torch.tensor(miss_indices, dtype=torch.long)
+
+
+def load_tickers(full_dataset, path='tickers.pt'):
+    """Tickers of the companies of full_data.pt, saved alongside it by niceify_data."""
+    tickers = torch.load(path)
+    if len(tickers) != len(full_dataset):
+        raise ValueError(f'{path} has {len(tickers)} tickers for {len(full_dataset)} companies, rerun niceify_data')
+    return tickers
+
+
+def score_universe(model_path='test_model.pt', cache_path=CACHE_PATH):
+    full_dataset = torch.load('full_data.pt')
+    tickers = load_tickers(full_dataset)
+    windows, company_indices = get_last_windows(full_dataset)
+    companies = [tickers[index] for index in company_indices.tolist()]
+
+    model = MaskedNet(
+        input_size=3*len(INPUT_FIELDS),
+        output_size=len(OUTPUT_VECTOR_FIELDS),
+        number_of_currencies=47,
+    ).to(DEVICE)
+    model.load_state_dict(load_checkpoint(model_path, map_location=DEVICE))
+
+    cache = PredictionCache(cache_path)
+    try:
+        predictions, rescored = score_incrementally(model, windows, companies, get_checkpoint_id(model_path), cache)
+    finally:
+        cache.close()
+    return companies, predictions, rescored
+
+
+if __name__ == '__main__':
+    score_universe()
@@ -0,0 +1,143 @@
+import glob
+import os
+import random
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from evaluation import evaluate
+from helpers.niceify_data import SHARD_FILE, save_shard
+from train import BATCH_SIZE, DEVICE, INPUT_FIELDS, LEARNING_RATE, NUM_EPOCHS, OUTPUT_VECTOR_FIELDS, WEIGHT_DECAY, MaskedNet, train_epoch
+
+SHARD_DIR = 'shards'
+COMPANIES_PER_SHARD = 1000
+SHUFFLE_BUFFER_SIZE = 65536
+MAX_TRAIN_OFFSET = 50  # same history depth as get_train_dataloader
+NUM_WORKERS = 4
+
+
+def write_shards(full_dataset, directory=SHARD_DIR, companies_per_shard=COMPANIES_PER_SHARD):
+    """Splits an in-memory preprocessed dataset (e.g. full_data.pt) into shards readable by ShardedWindowDataset."""
+    return [save_shard(full_dataset[start:start + companies_per_shard], directory, shard_index)
+            for shard_index, start in enumerate(range(0, len(full_dataset), companies_per_shard))]
+
+
+def get_shard_paths(directory=SHARD_DIR):
+    return sorted(glob.glob(os.path.join(directory, SHARD_FILE.replace('{:05d}', '*'))))
+
+
+class ShardedWindowDataset(IterableDataset):
+    """
+    Streams (window, target) pairs from preprocessed shards, building the windows on the fly, so only the shards
+    currently being read and the shuffle buffer are held in memory.
+
+    split='train' yields the same windows as get_train_dataloader, split='val' the same as get_val_dataloader.
+    Training shards are read in an order reshuffled every epoch (see set_epoch) and samples go through a bounded
+    shuffle buffer. Shards are dealt round-robin to DataLoader workers, so each sample is produced exactly once per epoch
+    and the stream only depends on (seed, epoch, number of workers).
+    """
+    def __init__(self, shard_paths, output_field_indices, split='train', shuffle_buffer_size=SHUFFLE_BUFFER_SIZE, max_offset=MAX_TRAIN_OFFSET, seed=42):
+        super().__init__()
+        if split not in ('train', 'val'):
+            raise ValueError(f'Unknown split: {split}')
+        self.shard_paths = list(shard_paths)
+        self.output_field_indices = output_field_indices
+        self.split = split
+        self.shuffle_buffer_size = shuffle_buffer_size if split == 'train' else 0
+        self.max_offset = max_offset
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _get_worker_shards(self):
+        shard_paths = self.shard_paths
+        if self.split == 'train':
+            shard_paths = list(shard_paths)
+            random.Random(self.seed * 1_000_003 + self.epoch).shuffle(shard_paths)
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return shard_paths
+        return shard_paths[worker_info.id::worker_info.num_workers]
+
+    def _get_company_windows(self, company_statements):
+        if self.split == 'val':
+            if company_statements.shape[0] < 4:
+                return
+            window = torch.flatten(company_statements[-4:-1])
+            if (window == 0).sum() > window.shape[0]*0.5:
+                return
+            yield window, torch.index_select(company_statements[-1], dim=-1, index=self.output_field_indices)
+            return
+
+        for i in range(self.max_offset):
+            if company_statements.shape[0] < i + 5:
+                break
+            window = torch.flatten(company_statements[-i-5:-i-2])
+            yield window, torch.index_select(company_statements[-i-2], dim=-1, index=self.output_field_indices)
+
+    def _iterate_samples(self, shard_paths):
+        for path in shard_paths:
+            # Memory-mapped, so only the companies being windowed get paged in
+            for company_statements in torch.load(path, mmap=True):
+                yield from self._get_company_windows(company_statements)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        samples = self._iterate_samples(self._get_worker_shards())
+        if not self.shuffle_buffer_size:
+            yield from samples
+            return
+
+        rng = random.Random((self.seed * 1_000_003 + self.epoch) * 1_009 + worker_id)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            index = rng.randrange(self.shuffle_buffer_size)
+            yield buffer[index]
+            buffer[index] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def get_streaming_dataloader(shard_paths, output_field_indices, batch_size, split='train', num_workers=NUM_WORKERS, **dataset_kwargs):
+    dataset = ShardedWindowDataset(shard_paths, output_field_indices, split=split, **dataset_kwargs)
+    # A worker without shards would just exit early, no point in starting more workers than there are shards
+    num_workers = min(num_workers, len(dataset.shard_paths))
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+
+def train_streaming(shard_dir=SHARD_DIR, num_workers=NUM_WORKERS):
+    output_field_indices = torch.tensor([INPUT_FIELDS.index(field) for field in OUTPUT_VECTOR_FIELDS])
+    shard_paths = get_shard_paths(shard_dir)
+    train_data_loader = get_streaming_dataloader(shard_paths, output_field_indices, BATCH_SIZE, split='train', num_workers=num_workers)
+    val_data_loader = get_streaming_dataloader(shard_paths, output_field_indices, BATCH_SIZE, split='val', num_workers=num_workers)
+
+    model = MaskedNet(
+        input_size=3*len(INPUT_FIELDS),
+        output_size=len(OUTPUT_VECTOR_FIELDS),
+        number_of_currencies=47,
+    ).to(DEVICE)
+    optimizer = optim.AdamW(model.parameters(), lr=LEARNING_RATE, weight_decay=WEIGHT_DECAY)
+    best_val_loss = float('inf')
+
+    for epoch in range(NUM_EPOCHS):
+        # Workers get a fresh copy of the dataset at every epoch, so this reshuffles the shard order
+        train_data_loader.dataset.set_epoch(epoch)
+        train_loss = train_epoch(model, train_data_loader, optimizer, DEVICE)
+        val_metrics = evaluate(model, val_data_loader, DEVICE, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=INPUT_FIELDS, quantiles=None)
+        val_loss, target_loss = val_metrics['loss'], val_metrics['target_loss']
+
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            torch.save(model.state_dict(), 'test_model.pt')
+
+        print(f'Epoch {epoch}: Train Loss: {train_loss:.4f}, Val Loss: {val_loss:.4f}, Best VL: {best_val_loss:.4f}, Target: {target_loss:.4f}')
+
+
+if __name__ == '__main__':
+    train_streaming()
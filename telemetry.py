@@ -0,0 +1,163 @@
+import json
+import os
+import resource
+import time
+import torch
+
+
+def get_rss_bytes():
+    """Current resident set size of this process, falling back to the peak RSS where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_condition_numbers(model):
+    """Largest singular value, smallest singular value and condition number of every weight matrix of the model."""
+    singular_values = {}
+    with torch.no_grad():
+        for name, parameter in model.named_parameters():
+            if 'weight' not in name or parameter.dim() != 2:
+                continue
+            try:
+                S = torch.linalg.svdvals(parameter.detach().float())
+                singular_values[name] = (S[0].item(), S[-1].item(), (S[0] / S[-1]).item())
+            except RuntimeError:
+                singular_values[name] = (float('nan'), float('nan'), float('inf'))
+    return singular_values
+
+
+class Telemetry:
+    """
+    Per-step training telemetry written as one JSON line per step to log_path:
+    phase timings (data, forward, backward, optimizer), per-layer forward timings and activation statistics,
+    samples/sec, RSS memory, and every svd_every steps the singular values of the weight matrices.
+    Optionally exports the step phases and layer forwards of every trace_every-th step as a Chrome trace (chrome://tracing,
+    Perfetto), streamed to trace_path as a JSON array so that memory stays flat and a crashed run keeps its trace
+    (the trace format accepts an unterminated array).
+    When disabled (no log_path), every call returns immediately and no hooks are registered.
+    """
+    def __init__(self, log_path=None, trace_path=None, stats_every=100, svd_every=1000, trace_every=10, synchronize=False):
+        self.enabled = log_path is not None
+        self.log_path = log_path
+        self.trace_path = trace_path
+        self.stats_every = stats_every
+        self.svd_every = svd_every
+        self.trace_every = trace_every
+        # Wait for pending device work before reading the clock, otherwise CUDA timings only measure kernel launches
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.log_file = open(log_path, 'a') if self.enabled else None
+        self.trace_file = open(trace_path, 'w') if self.enabled and trace_path is not None else None
+        self.trace_separator = '['
+        self.hook_handles = []
+        self.model = None
+        self.step = 0
+        self.origin = time.perf_counter()
+        self.last_mark = self.origin
+        self.step_start = self.origin
+        self.phases = {}
+        self.layer_starts = {}
+        self.layer_times = {}
+        self.layer_stats = {}
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _trace(self, name, start, end, tid):
+        if self.trace_file is not None and self.step % self.trace_every == 0:
+            event = {'name': name, 'ph': 'X', 'pid': 0, 'tid': tid, 'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+            self.trace_file.write(self.trace_separator + json.dumps(event) + '\n')
+            self.trace_separator = ','
+
+    def attach(self, model, layer_type):
+        """Registers timing and activation statistics hooks on every `layer_type` submodule of the model."""
+        if not self.enabled:
+            return
+        self.model = model
+        for name, module in model.named_modules():
+            if isinstance(module, layer_type):
+                self.hook_handles.append(module.register_forward_pre_hook(self._make_pre_hook(name)))
+                self.hook_handles.append(module.register_forward_hook(self._make_hook(name)))
+
+    def _make_pre_hook(self, name):
+        def pre_hook(module, inputs):
+            if module.training:
+                self.layer_starts[name] = self._now()
+        return pre_hook
+
+    def _make_hook(self, name):
+        def hook(module, inputs, outputs):
+            # Only training forwards belong to a step, validation passes are left out
+            if not module.training:
+                return
+            end = self._now()
+            start = self.layer_starts.pop(name)
+            self.layer_times[name] = self.layer_times.get(name, 0.0) + end - start
+            self._trace(name, start, end, tid=1)
+            if self.step % self.stats_every == 0:
+                values = outputs[0].detach() if isinstance(outputs, tuple) else outputs.detach()
+                # Kept as tensors until the end of the step so that the hook itself doesn't sync
+                self.layer_stats[name] = torch.stack((values.mean(), values.std(), (values <= 0).float().mean()))
+        return hook
+
+    def begin_step(self):
+        if not self.enabled:
+            return
+        self.step_start = self.last_mark = self._now()
+
+    def mark(self, phase):
+        """Attributes the time elapsed since the previous mark (or the start of the step) to `phase`."""
+        if not self.enabled:
+            return
+        now = self._now()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last_mark
+        self._trace(phase, self.last_mark, now, tid=0)
+        self.last_mark = now
+
+    def end_step(self, batch_size, loss=None):
+        if not self.enabled:
+            return
+        now = self._now()
+        step_time = now - self.step_start
+        record = {
+            'step': self.step,
+            'time': now - self.origin,
+            'loss': loss,
+            'step_time': step_time,
+            'samples_per_sec': batch_size / step_time if step_time > 0 else None,
+            'rss_bytes': get_rss_bytes(),
+            'phases': self.phases,
+            'layer_times': self.layer_times,
+        }
+        if self.layer_stats:
+            record['layer_stats'] = {name: dict(zip(('mean', 'std', 'non_positive'), stats.tolist())) for name, stats in self.layer_stats.items()}
+        if self.model is not None and self.svd_every and self.step % self.svd_every == 0:
+            record['singular_values'] = {name: dict(zip(('max', 'min', 'condition_number'), values)) for name, values in get_condition_numbers(self.model).items()}
+        self.log(record)
+
+        self.step += 1
+        self.phases = {}
+        self.layer_times = {}
+        self.layer_stats = {}
+        self.step_start = self.last_mark = self._now()
+
+    def log(self, record):
+        if not self.enabled:
+            return
+        self.log_file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if not self.enabled:
+            return
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+        self.log_file.close()
+        if self.trace_file is not None:
+            # An empty trace still has to be a valid array
+            self.trace_file.write('[]' if self.trace_separator == '[' else ']')
+            self.trace_file.close()
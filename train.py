@@ -7,6 +7,10 @@ import torch.optim as optim
 from itertools import islice
 import torch.nn as nn
 from torch.nn import functional as F
+from evaluation import evaluate
+from attribution import get_attributions
+from telemetry import Telemetry, get_condition_numbers
+from precision import CompactDataset, CompactWindowBuilder, CompactWindowLoader
 
 # Hyperparams
 BATCH_SIZE = 512
@@ -17,6 +21,9 @@ MAX_DROPOUT_PROB = 0.0
 NUM_INPUT_FIELDS = 32
 BAD_EXAMPLE_CUTOFF = 20
 WEIGHT_DECAY = 0.0
+TELEMETRY_LOG = None  # e.g. 'telemetry.jsonl' to record per-step training telemetry
+TELEMETRY_TRACE = None  # e.g. 'trace.json' to also export the step phases as a Chrome trace
+STORAGE_DTYPE = None  # e.g. torch.bfloat16 to keep the preprocessed dataset and the training and validation windows in half precision
 
 # Fields to predict:
 # OUTPUT_VECTOR_FIELDS = ["interestIncome", "interestExpense", "ebitda", "operatingIncome", "incomeBeforeTax", "netIncome", "eps", "epsdiluted",] # These output fields are for net_income_and_stuff_model.pt
@@ -77,14 +84,16 @@ class MaskedSequential(nn.Module):
         return x
 
 class MaskedNet(nn.Module):
-    def __init__(self, input_size, output_size, number_of_currencies, dropout_prob=0.1):
+    def __init__(self, input_size, output_size, number_of_currencies, dropout_prob=0.1, hidden_sizes=None):
         super().__init__()
+        # Pruned models keep the hidden sizes of the model they were cut from
+        hidden_sizes = hidden_sizes or (input_size//8, input_size//12)
         self.currency_embedding = nn.Embedding(num_embeddings=number_of_currencies, embedding_dim=2)
         self.dropout = nn.Dropout(MAX_DROPOUT_PROB)
         self.lm_head = MaskedSequential(
-            MaskedLayer(input_size + 1, input_size//8),
-            MaskedLayer(input_size//8, input_size//12),
-            nn.Linear(input_size//12, output_size)
+            MaskedLayer(input_size + 1, hidden_sizes[0]),
+            MaskedLayer(hidden_sizes[0], hidden_sizes[1]),
+            nn.Linear(hidden_sizes[1], output_size)
         )
 
     def forward(self, input, targets=None, clean_dataset=False):
@@ -94,8 +103,8 @@ class MaskedNet(nn.Module):
         currency_idx = input[:, -1].long()
         currency_embedding = self.currency_embedding(currency_idx)
         combined_input = torch.cat([main_features, currency_embedding], dim=1)
-        mask_invalid = torch.cat([mask_invalid, torch.zeros(mask_invalid.shape[0], 2)], dim=1)
-        mask_zero = torch.cat([mask_zero, torch.zeros(mask_zero.shape[0], 2)], dim=1)
+        mask_invalid = torch.cat([mask_invalid, torch.zeros(mask_invalid.shape[0], 2, device=input.device)], dim=1)
+        mask_zero = torch.cat([mask_zero, torch.zeros(mask_zero.shape[0], 2, device=input.device)], dim=1)
 
         output = self.lm_head(combined_input, mask_zero, mask_invalid)
 
@@ -141,8 +150,23 @@ class MaskedNet(nn.Module):
 
 
 
-def get_val_dataloader(full_dataset, output_field_indices, batch_size):
-    input_data = []
+def load_checkpoint_bundle(path, map_location=torch.device('cpu')):
+    """state_dict of a checkpoint, and what exported models (e.g. pruned ones) bundle with it: field lists, hidden sizes."""
+    state_dict = torch.load(path, map_location=map_location)
+    metadata = {}
+    if 'state_dict' in state_dict:
+        metadata = {key: value for key, value in state_dict.items() if key != 'state_dict'}
+        state_dict = state_dict['state_dict']
+    # MaskedLayer.main_proj used to be called values_proj (test_model.pt)
+    return {key.replace('.values_proj.', '.main_proj.'): value for key, value in state_dict.items()}, metadata
+
+
+def load_checkpoint(path, map_location=torch.device('cpu')):
+    return load_checkpoint_bundle(path, map_location)[0]
+
+
+def get_val_dataloader(full_dataset, output_field_indices, batch_size, storage_dtype=None):
+    input_data = [] if storage_dtype is None else CompactWindowBuilder(storage_dtype)
     ground_truth = []
     excluded_counter = 0
     total_counter = 0
@@ -160,99 +184,80 @@ def get_val_dataloader(full_dataset, output_field_indices, batch_size):
         ground_truth.append(sub_ground_truth)
 
     ground_truth = torch.stack(ground_truth)  # Changed from torch.tensor to torch.stack
+    print(f'Share of bad val examples: {excluded_counter/total_counter:.4f}')
+    if storage_dtype is not None:
+        return CompactWindowLoader(*input_data.finish(), ground_truth, batch_size)
     input_data = torch.stack(input_data)      # Changed from torch.tensor to torch.stack
     val_dataset = TensorDataset(input_data, ground_truth)
-    print(f'Share of bad val examples: {excluded_counter/total_counter:.4f}')
     return DataLoader(val_dataset, batch_size=batch_size)
 
 
-def get_train_dataloader(full_dataset, output_field_indices, batch_size):
-    input_data = []
+def get_train_dataloader(full_dataset, output_field_indices, batch_size, storage_dtype=None):
+    input_data = [] if storage_dtype is None else CompactWindowBuilder(storage_dtype)
     ground_truth = []
     excluded_counter = 0
     total_counter = 0
-    for i in range(0, 50):
-        for company_statements in full_dataset:
-            if (company_statements.shape[0] < i + 5):
-                continue
-            total_counter += 1
-            to_append = torch.flatten(company_statements[-i-5:-i-2])
-            mask = to_append == 0
-            # if to_append[mask].shape[0] > to_append.shape[0]*0.5:
-            #     excluded_counter += 1
-            #     continue
-            input_data.append(to_append)
-            sub_ground_truth = torch.index_select(company_statements[-i-2], dim=-1, index=output_field_indices)
-            ground_truth.append(sub_ground_truth)
+    if storage_dtype is None:
+        offsets_and_companies = ((i, company_statements) for i in range(0, 50) for company_statements in full_dataset)
+    else:
+        # Reading a CompactDataset company decompresses it, so each one is read once for all of its offsets
+        offsets_and_companies = ((i, company_statements) for company_statements in full_dataset for i in range(0, 50))
+    for i, company_statements in offsets_and_companies:
+        if (company_statements.shape[0] < i + 5):
+            continue
+        total_counter += 1
+        to_append = torch.flatten(company_statements[-i-5:-i-2])
+        mask = to_append == 0
+        # if to_append[mask].shape[0] > to_append.shape[0]*0.5:
+        #     excluded_counter += 1
+        #     continue
+        input_data.append(to_append)
+        sub_ground_truth = torch.index_select(company_statements[-i-2], dim=-1, index=output_field_indices)
+        ground_truth.append(sub_ground_truth)
 
     ground_truth = torch.stack(ground_truth)  # Changed from torch.tensor to torch.stack
+    print(f'Share of bad training examples: {excluded_counter/total_counter:.4f}')
+    if storage_dtype is not None:
+        return CompactWindowLoader(*input_data.finish(), ground_truth, batch_size, shuffle=True)
     input_data = torch.stack(input_data)      # Changed from torch.tensor to torch.stack
     training_dataset = TensorDataset(input_data, ground_truth)
 
-    print(f'Share of bad training examples: {excluded_counter/total_counter:.4f}')
-
     return DataLoader(training_dataset, batch_size=batch_size, shuffle=True)
 
 
-def train_epoch(model, train_loader, optimizer, device):
+def train_epoch(model, train_loader, optimizer, device, telemetry=None):
     model.train()
     total_loss = 0
     length = 0
+    telemetry = telemetry or Telemetry()
 
+    telemetry.begin_step()
     for batch_idx, (data, targets) in enumerate(train_loader):
         data, targets = data.to(device), targets.to(device)
+        telemetry.mark('data')
 
         optimizer.zero_grad()
         output, loss = model(data, targets)
+        telemetry.mark('forward')
 
         if loss is None:
             continue
 
         loss.backward()
+        telemetry.mark('backward')
         optimizer.step()
+        telemetry.mark('optimizer')
 
-        total_loss += loss.item()
+        batch_loss = loss.item()
+        total_loss += batch_loss
         length += 1
 
         if batch_idx%1000 == 0:
             print(f'Training loss: {loss}')
 
-    return total_loss / length
-
-
-def get_target_loss(val_loader, output_data_indices=None):
-    total_target_loss = 0
-    total_length = 0
-
-    for data, targets in val_loader:
-        carry_over_data = torch.index_select(data, dim=-1, index=output_data_indices)
-
-        length = data.shape[0]
-        loss = F.l1_loss(carry_over_data, targets).item() * length
-        total_target_loss += loss
-        total_length += length
-
-    return total_target_loss / total_length
-
-
-def validate(model, val_loader, device, output_data_indices=None):
-    model.eval()
-    total_loss = 0
-    total_length = 0
-    total_target_loss = 0
-
-    with torch.no_grad():
-        for data, targets in val_loader:
-            data, targets = data.to(device), targets.to(device)
-            output, loss = model(data, targets)
-
-            if loss is None:
-                continue
-            length = len(data)
-            total_length += length
-            total_loss += loss.item() * length
+        telemetry.end_step(batch_size=data.shape[0], loss=batch_loss)
 
-    return total_loss / total_length
+    return total_loss / length
 
 
 def cleanDataset(model, train_loader, device, train_loss):
@@ -292,28 +297,12 @@ def cleanDataset(model, train_loader, device, train_loss):
 
 
 def get_output_gradients(model, val_loader, device, output_field:str, input_fields:list, output_fields:list):
-    model.eval()
-    all_gradients = []
-
-    output_index = output_fields.index(output_field)
-
-    input_dict = {f'{input_fields[i]}': i for i in range(len(INPUT_FIELDS))}
-
-    for data, targets in val_loader:
-        data = data.to(device)
-        data.requires_grad = True
+    # Attributions for every output come out of one pass, this only reports the requested one
+    attributions = get_attributions(model, val_loader, device, input_fields=input_fields, output_fields=output_fields)
+    gradients = attributions['sum'][output_fields.index(output_field)]
+    gradients /= gradients.max()
 
-        output, _ = model(data, targets.to(device))
-        output[:, output_index].sum().backward()
-        
-        gradients = data.grad.clone().sum(dim=0)
-        # immediate_gradients_dict = {key: (float(gradients[value]), float(gradients[value+len(INPUT_FIELDS)]), float(gradients[value+len(INPUT_FIELDS)*2])) for key, value in input_dict.items()}
-        all_gradients.append(gradients)  # Store gradients for this batch
-
-    all_gradients = torch.stack(all_gradients, dim=0)
-    all_gradients_sum = all_gradients.sum(dim=0)
-    all_gradients_sum /= all_gradients_sum.max()
-    full_gradients_dict = {key: (float(all_gradients_sum[value]), float(all_gradients_sum[value+len(INPUT_FIELDS)]), float(all_gradients_sum[value+len(INPUT_FIELDS)*2])) for key, value in input_dict.items()}
+    full_gradients_dict = {field: tuple(gradients[i].tolist()) for i, field in enumerate(input_fields)}
     csv_string = '"Metric", "n-3", "n-2", "n-1"\n'
     for metric, values in full_gradients_dict.items():
         csv_string += f'"{metric}", {values[0]}, {values[1]}, {values[2]}\n'
@@ -322,34 +311,8 @@ def get_output_gradients(model, val_loader, device, output_field:str, input_fiel
 
 
 def get_predictibility(model, val_loader, device, output_fields:list[str], input_fields:list[str]):
-    model.eval()
-    total_loss = 0
-    total_length = 0
-    total_target_loss = 0
-    output_data_indices = [input_fields.index(field) for field in output_fields]
-    target_losses = torch.zeros(len(output_fields))
-    attained_losses = torch.zeros(len(output_fields))
-    composite_losses = torch.zeros(len(output_fields))
-    predictibility = {}
-
-    with torch.no_grad():
-        for data, targets in val_loader:
-            data, targets = data.to(device), targets.to(device)
-            output, _ = model(data, targets)
-            length = data.shape[0]
-            for output_index, input_index in enumerate(output_data_indices):
-                carry_over_data = data[:, len(input_fields) * 2 + input_index]
-                target_losses[output_index] += F.l1_loss(carry_over_data, targets[:,output_index]).item() * length
-                attained_losses[output_index] += F.l1_loss(output[:,output_index], targets[:,output_index]).item() * length
-                composite_losses[output_index] += F.l1_loss((output[:,output_index] + carry_over_data*2.5)/3.5, targets[:,output_index]).item() * length
-
-            total_length += length
-            
-        target_losses /= total_length
-        attained_losses /= total_length
-        composite_losses /= total_length
-
-        predictibility = {field: (float(target_losses[index]), float(attained_losses[index]), float(composite_losses[index])) for index, field in enumerate(output_fields)}
+    metrics = evaluate(model, val_loader, device, output_fields=output_fields, input_fields=input_fields, quantiles=None)
+    predictibility = {field: (values['target_loss'], values['loss'], values['composite_loss']) for field, values in metrics['fields'].items()}
 
     return predictibility
 
@@ -358,9 +321,12 @@ def train():
     OUTPUT_SIZE = len(OUTPUT_VECTOR_FIELDS)
     # Load and prepare data
     output_field_indices = torch.tensor([INPUT_FIELDS.index(field) for field in OUTPUT_VECTOR_FIELDS])
-    full_dataset = torch.load('full_data.pt')
-    val_data_loader = get_val_dataloader(full_dataset=full_dataset, output_field_indices=output_field_indices, batch_size=BATCH_SIZE)
-    train_data_loader = get_train_dataloader(full_dataset=full_dataset, output_field_indices=output_field_indices, batch_size=BATCH_SIZE)
+    # In reduced precision, companies are decompressed one at a time and the windows are built compressed
+    full_dataset = torch.load('full_data.pt') if STORAGE_DTYPE is None else CompactDataset.load('full_data.pt', STORAGE_DTYPE)
+    val_data_loader = get_val_dataloader(full_dataset=full_dataset, output_field_indices=output_field_indices, batch_size=BATCH_SIZE, storage_dtype=STORAGE_DTYPE)
+    train_data_loader = get_train_dataloader(full_dataset=full_dataset, output_field_indices=output_field_indices, batch_size=BATCH_SIZE, storage_dtype=STORAGE_DTYPE)
+    # Only the windows are needed from here on
+    del full_dataset
 
     # Initialize model
     model = MaskedNet(
@@ -377,17 +343,19 @@ def train():
     # Initialize optimizer
     optimizer = optim.AdamW(model.parameters(), lr=LEARNING_RATE, weight_decay=WEIGHT_DECAY)
 
+    telemetry = Telemetry(TELEMETRY_LOG, trace_path=TELEMETRY_TRACE)
+    telemetry.attach(model, MaskedLayer)
+
     # Training loop
     best_val_loss = float('inf')
 
-    target_loss = get_target_loss(val_loader=val_data_loader, output_data_indices=output_field_indices+len(INPUT_FIELDS)*2)
-
     for epoch in range(NUM_EPOCHS):
-        train_loss = train_epoch(model, train_data_loader, optimizer, DEVICE)
-        val_loss = validate(model, val_data_loader, DEVICE)
+        train_loss = train_epoch(model, train_data_loader, optimizer, DEVICE, telemetry=telemetry)
+        # One pass for the model loss and the carry-over target loss
+        val_metrics = evaluate(model, val_data_loader, DEVICE, output_fields=OUTPUT_VECTOR_FIELDS, input_fields=INPUT_FIELDS, quantiles=None)
+        val_loss, target_loss = val_metrics['loss'], val_metrics['target_loss']
         # train_data_loader = cleanDataset(model, train_data_loader, DEVICE, val_loss)
         # train_loss = train_epoch(model, fine_tune_dataloader, optimizer, DEVICE)
-        # val_loss = validate(model, val_data_loader, DEVICE)
         # print(f'Epoch {epoch}-ft: Train Loss: {train_loss:.4f}, Val Loss: {val_loss:.4f}, Best VL: {best_val_loss:.4f}, Target: {target_loss:.4f}')
 
         if val_loss < best_val_loss:
@@ -395,6 +363,9 @@ def train():
             torch.save(model.state_dict(), 'test_model.pt')
 
         print(f'Epoch {epoch}: Train Loss: {train_loss:.4f}, Val Loss: {val_loss:.4f}, Best VL: {best_val_loss:.4f}, Target: {target_loss:.4f}')
+        telemetry.log({'epoch': epoch, 'train_loss': train_loss, 'val_loss': val_loss, 'best_val_loss': best_val_loss, 'target_loss': target_loss})
+
+    telemetry.close()
 
 def test():
         # Fields to predict
@@ -413,7 +384,7 @@ def test():
     ).to(DEVICE)
 
 
-    model.load_state_dict(torch.load('test_model.pt', map_location=torch.device('cpu')))
+    model.load_state_dict(load_checkpoint('test_model.pt'))
     # std = torch.load('std.pt')
     # mean = torch.load('mean.pt')
     # currency_indices = torch.load('currency_indices.pt')
@@ -442,21 +413,9 @@ def get_layers_condition_number():
     )
     
     # Load the state dict
-    model.load_state_dict(torch.load('test_model.pt', map_location=torch.device('cpu')))
+    model.load_state_dict(load_checkpoint('test_model.pt'))
     
-    condition_numbers = {}
-    for name, parameter in model.named_parameters():
-        if 'weight' in name:
-            weight_matrix = parameter.data
-            
-            # Calculate SVD
-            try:
-                U, S, V = torch.svd(weight_matrix)
-                condition_number = S[0] / S[-1]
-                
-                condition_numbers[name] = condition_number.item()
-            except:
-                condition_numbers[name] = float('inf')
+    condition_numbers = {name: values[2] for name, values in get_condition_numbers(model).items()}
     
     return condition_numbers
 